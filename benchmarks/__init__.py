@@ -0,0 +1,11 @@
+"""PyQuo benchmarks. Run them from the root of the repository, e.g.
+
+    python3 -m benchmarks.suite --pages 1000 10000 100000
+
+suite       full and no-op builds, aggregation and emitters at several sizes
+corpus      the synthetic sites the suite builds and in-memory pages
+nested_tree aggregation on deeply nested source trees
+index_scaling  search index construction on large in-memory sites
+emit        the emitters alone, on pre-rendered pages
+startup     start-up time of the lightweight commands, against a budget
+"""
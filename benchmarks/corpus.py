@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""Synthetic sites for the benchmarks, written with pyquo's own create_entry.
+
+synthetic_pages makes up parsed pages in memory instead, for the benchmarks
+of a single phase. Everything is derived from a seeded random generator, so
+a given set of arguments always produces exactly the same site.
+
+    python3 -m benchmarks.corpus DIRECTORY [--pages 1000] [--depth 2] ...
+"""
+
+import os
+import sys
+import random
+import argparse
+from types import SimpleNamespace
+from collections import Counter
+from datetime import date, timedelta
+
+from pyquo import pyquo
+
+EPOCH = date(1800, 1, 1)
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'pe', 'da',
+             'zu', 'go', 'ha', 'ji', 'be', 'no', 'wa', 'ye']
+CATEGORIES = ['blog', 'work', 'travel', 'personal', 'music', 'books',
+              'code', 'food', 'photos', 'notes']
+
+
+def vocabulary(size, rnd):
+    """size made up words, most common first, with Zipf weights."""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choice(SYLLABLES)
+                          for _ in range(rnd.randint(2, 5))))
+    words = sorted(words)
+    rnd.shuffle(words)
+    return words, [1.0 / (rank + 1) for rank in range(size)]
+
+
+def body(rnd, words, weights, paragraphs, words_per_paragraph):
+    """Markdown with the odd heading, list and link among the paragraphs."""
+    blocks = []
+    for num in range(paragraphs):
+        text = rnd.choices(words, weights, k=words_per_paragraph)
+        kind = rnd.random()
+        if kind < 0.1:
+            blocks.append('## ' + ' '.join(text[:4]).title())
+            blocks.append(' '.join(text[4:]))
+        elif kind < 0.2:
+            blocks.append('\n'.join('* ' + ' '.join(text[start:start + 8])
+                                    for start in range(0, len(text), 8)))
+        elif kind < 0.3:
+            blocks.append('{} [{}](http://example.com/{}) {}'.format(
+                ' '.join(text[:10]), text[10], text[11],
+                ' '.join(text[12:])))
+        else:
+            blocks.append(' '.join(text))
+    return '\n\n'.join(blocks) + '\n'
+
+
+def folder_for(root, num, depth, fanout=10):
+    """Spread pages over fanout ** depth directories, depth levels deep."""
+    return os.path.join(root, *['d{}'.format(num // fanout ** level % fanout)
+                                for level in range(depth)])
+
+
+def generate_corpus(directory, pages, categories=4, tags=40, paragraphs=5,
+                    words_per_paragraph=60, date_collisions=0.1, depth=1,
+                    vocabulary_size=8000, unpublished=0.02, seed=0):
+    """Write a site of pages markdown sources under directory.
+
+    date_collisions is the fraction of pages dated the same day as the page
+    before them, and unpublished the fraction with Publish set to False.
+    Returns the paths written, in order.
+    """
+    rnd = random.Random(seed)
+    words, weights = vocabulary(vocabulary_size, rnd)
+    category_names = CATEGORIES[:categories]
+    tag_names = ['tag{}'.format(num) for num in range(tags)]
+    tag_weights = [1.0 / (rank + 1) for rank in range(tags)]
+    day = 0
+    paths = []
+    for num in range(pages):
+        if num and rnd.random() >= date_collisions:
+            day += 1
+        page_categories = rnd.sample(category_names,
+                                     min(len(category_names),
+                                         1 + (rnd.random() < 0.2)))
+        page_tags = sorted(set(rnd.choices(tag_names, tag_weights,
+                                           k=rnd.randint(1, 3))))
+        paths.append(pyquo.create_entry(
+            folder_for(directory, num, depth),
+            timestamp=(EPOCH + timedelta(days=day)).isoformat(),
+            title='{} {}'.format(rnd.choice(words).title(), num),
+            filename='page{}'.format(num),
+            categories=page_categories,
+            name='Bench',
+            tags=', '.join(page_tags),
+            header_image='header{}.png'.format(num % 20)
+            if rnd.random() < 0.25 else '',
+            publish_bool='False' if rnd.random() < unpublished else 'True',
+            content=body(rnd, words, weights, paragraphs,
+                         words_per_paragraph)))
+    return paths
+
+
+def synthetic_pages(count, categories=4, tags=40, paragraphs=5,
+                    words_per_paragraph=60, vocabulary_size=8000,
+                    content=False, seed=0):
+    """count pages as a build holds them once parsed, made up in memory
+    without writing or converting any markdown. With content, each also has
+    its paragraphs as rendered HTML, for the emitters."""
+    rnd = random.Random(seed)
+    words, weights = vocabulary(vocabulary_size, rnd)
+    category_names = CATEGORIES[:categories]
+    for num in range(count):
+        text = rnd.choices(words, weights, k=paragraphs * words_per_paragraph)
+        meta = pyquo.load_meta({
+            'title': 'Page {}'.format(num),
+            'slug': 'page{}'.format(num),
+            'categories': rnd.sample(category_names,
+                                     min(len(category_names),
+                                         1 + (rnd.random() < 0.2))),
+            'authors': 'Bench',
+            'date': (EPOCH + timedelta(days=num)).isoformat(),
+            'tags': ['tag{}'.format(num % tags)],
+            'header_image': 'header{}.png'.format(num % 20)
+            if rnd.random() < 0.25 else '',
+            'publish': True,
+            'index': Counter(text)})
+        if content:
+            meta = SimpleNamespace(**pyquo.dump_meta(meta), content='\n'.join(
+                '<p>{}</p>'.format(' '.join(
+                    text[start:start + words_per_paragraph]))
+                for start in range(0, len(text), words_per_paragraph)))
+        yield meta
+
+
+def quiet(message):
+    """A log for the builds and emitters which drops their progress."""
+
+
+def add_arguments(parser):
+    """The corpus options, shared by every benchmark which writes one."""
+    parser.add_argument('--categories', type=int, default=4,
+                        help='number of categories (at most {})'.format(
+                            len(CATEGORIES)))
+    parser.add_argument('--tags', type=int, default=40,
+                        help='number of distinct tags')
+    parser.add_argument('--paragraphs', type=int, default=5,
+                        help='paragraphs per page')
+    parser.add_argument('--words', type=int, default=60,
+                        help='words per paragraph')
+    parser.add_argument('--collisions', type=float, default=0.1,
+                        help='fraction of pages sharing the previous date')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='levels of directories the pages are spread '
+                             'over, ten per level')
+    parser.add_argument('--vocabulary', type=int, default=8000)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def corpus_options(args):
+    return {'categories': args.categories, 'tags': args.tags,
+            'paragraphs': args.paragraphs, 'words_per_paragraph': args.words,
+            'date_collisions': args.collisions, 'depth': args.depth,
+            'vocabulary_size': args.vocabulary, 'seed': args.seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--pages', type=int, default=1000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    paths = generate_corpus(args.directory, args.pages,
+                            **corpus_options(args))
+    print('{} pages written under {}.'.format(len(paths), args.directory))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
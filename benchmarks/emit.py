@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+"""Benchmark of the emit phase alone: writing pages that are already parsed.
+
+Synthetic page metadata with pre-rendered HTML bodies is generated in
+memory, then the time taken by generate_static_page for every page, by the
+front and category pages and by the search page is measured separately.
+
+    python3 -m benchmarks.emit [--pages 10000]
+"""
+
+import gc
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from pyquo import pyquo
+from pyquo.templates import load_templates
+from benchmarks import corpus
+
+SETTINGS = {'site_title': 'Bench', 'homepage': 'index.html',
+            'searchpage': 'search.html', 'css': 'style.css',
+            'ts_frmt': 'dddd DD MMMM, YYYY', 'proj_root': '/'}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def emit(pages):
+    s = SETTINGS
+    timings = {}
+    templates = load_templates()
+    timings['pages'], _ = timed(lambda: [
+        pyquo.generate_static_page(s['site_title'], s['homepage'],
+                                   s['searchpage'], meta, s['css'],
+                                   s['ts_frmt'], s['proj_root'],
+                                   templates=templates)
+        for meta in pages])
+    _, (categories, tags, archives, index, word_cloud) = timed(
+        pyquo.extract_site_wide_metadata, pages, log=corpus.quiet)
+    timings['front and categories'], _ = timed(
+        pyquo.generate_front_and_category_pages, s['site_title'],
+        s['homepage'], s['searchpage'], categories, tags, archives,
+        word_cloud, s['proj_root'], s['css'], s['ts_frmt'], 10,
+        templates=templates, log=corpus.quiet)
+    timings['search'], _ = timed(
+        pyquo.generate_search_page, s['site_title'], s['homepage'],
+        s['searchpage'], index, s['css'], s['proj_root'],
+        templates=templates, log=corpus.quiet)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=10000)
+    parser.add_argument('--paragraphs', type=int, default=5)
+    parser.add_argument('--directory', default=None,
+                        help='write under this directory, e.g. a tmpfs')
+    args = parser.parse_args()
+
+    pages = list(corpus.synthetic_pages(args.pages,
+                                        paragraphs=args.paragraphs,
+                                        content=True))
+    # Keep collections of the synthetic corpus out of the timings:
+    gc.freeze()
+    workdir = tempfile.mkdtemp(prefix='pyquo-bench-', dir=args.directory)
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        timings = emit(pages)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print('{:<22} {:>10}'.format('emitter', 'seconds'))
+    for name, seconds in timings.items():
+        print('{:<22} {:>10.3f}'.format(name, seconds))
+    print('{:<22} {:>10.3f}'.format('total', sum(timings.values())))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+"""Scaling benchmark for the search index built by extract_site_wide_metadata.
+
+Synthetic pages with Zipf-distributed vocabulary are built in memory (no
+markdown is converted) and the time to extract the site-wide metadata and
+to score every term with BM25, as SearchIndex.search does, is measured at
+each size.
+
+    python3 -m benchmarks.index_scaling [--pages 10000 50000 100000]
+"""
+
+import sys
+import time
+import argparse
+
+from pyquo import pyquo
+from benchmarks import corpus
+
+
+def time_index(pages):
+    start = time.perf_counter()
+    index = pyquo.extract_site_wide_metadata(pages, log=corpus.quiet)[3]
+    extracted = time.perf_counter() - start
+    for term in index.postings:
+        index.scores(term)
+    scored = time.perf_counter() - start - extracted
+    return extracted, scored, len(index.postings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+',
+                        default=[10000, 50000, 100000])
+    parser.add_argument('--words', type=int, default=300,
+                        help='words per page')
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} {:>10} {:>10} {:>12}'.format(
+        'pages', 'terms', 'extract s', 'score s', 'us/page'))
+    for count in args.pages:
+        pages = list(corpus.synthetic_pages(
+            count, categories=3, paragraphs=1, words_per_paragraph=args.words,
+            vocabulary_size=args.vocabulary))
+        extracted, scored, terms = time_index(pages)
+        print('{:>8} {:>8} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+            count, terms, extracted, scored,
+            1e6 * (extracted + scored) / count))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
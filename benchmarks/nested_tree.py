@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+"""Regression benchmark for site-wide aggregation on a deeply nested tree.
+
+Builds the same number of pages spread over an increasingly deep directory
+tree and times a full `generate_pages` run. The site-wide metadata must be
+extracted exactly once per build and the time per page must stay flat as
+the number of directories grows.
+
+    python3 -m benchmarks.nested_tree [--pages N] [--depths 1 4 16 64]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from pyquo import pyquo
+from pyquo import site
+from benchmarks import corpus
+
+
+def create_tree(root, pages, depth):
+    """Spread `pages` entries over a chain of `depth` nested directories."""
+    folders = [os.path.join(root, *['d{}'.format(level)
+                                    for level in range(level_count)])
+               for level_count in range(depth)]
+    for num in range(pages):
+        day = (num % 28) + 1
+        pyquo.create_entry(
+            folders[num % depth], timestamp='2017-01-{:02d}'.format(day),
+            title='Entry {}'.format(num), filename='entry{}'.format(num),
+            categories=['blog', 'work'][num % 2:num % 2 + 1],
+            name='Bench', tags='bench, tag{}'.format(num % 7),
+            content='Body text for entry number {} with word{}.\n'.format(
+                num, num % 50))
+
+
+def time_build(pages, depth):
+    workdir = tempfile.mkdtemp(prefix='pyquo-bench-')
+    cwd = os.getcwd()
+    calls = []
+    # Site does the aggregation, with its own reference to the function:
+    extract = site.extract_site_wide_metadata
+
+    def counting_extract(*args, **kwargs):
+        calls.append(1)
+        return extract(*args, **kwargs)
+
+    site.extract_site_wide_metadata = counting_extract
+    try:
+        os.chdir(workdir)
+        create_tree(os.path.join(workdir, 'contents'), pages, depth)
+        properties = {'source_directory': 'contents'}
+        start = time.perf_counter()
+        pyquo.generate_pages(properties, log=corpus.quiet)
+        elapsed = time.perf_counter() - start
+    finally:
+        site.extract_site_wide_metadata = extract
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return elapsed, len(calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=400)
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=[1, 4, 16, 64])
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='allowed growth in time per page')
+    args = parser.parse_args()
+
+    print('{:>6} {:>6} {:>10} {:>12} {:>9}'.format(
+        'depth', 'pages', 'seconds', 'ms/page', 'extracts'))
+    per_page = []
+    failed = False
+    for depth in args.depths:
+        elapsed, extracts = time_build(args.pages, depth)
+        per_page.append(elapsed / args.pages)
+        print('{:>6} {:>6} {:>10.3f} {:>12.3f} {:>9}'.format(
+            depth, args.pages, elapsed, 1000 * per_page[-1], extracts))
+        if extracts != 1:
+            failed = True
+    if per_page[-1] > per_page[0] * args.tolerance:
+        print('Time per page grew {:.1f}x with directory depth'
+              .format(per_page[-1] / per_page[0]))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""Startup benchmark: how long the lightweight commands take to start.
+
+Each command runs for real in a fresh interpreter under python -X
+importtime, with HOME pointing at a temporary directory whose properties
+file names a source directory there and no text editor, so that new writes
+an entry without opening it, and the browser view opens is true(1).
+It fails if a command imports one of the heavy dependencies only builds
+need, or if importing pyquo.pyquo takes longer than the budget, so it can
+guard against regressions.
+
+    python3 -m benchmarks.startup [--budget 40] [--runs 5] [--json FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+COMMANDS = [['--help'], ['properties'], ['new', 'notes'], ['view'],
+            ['list', '--help']]
+
+# Modules which only building, serving or the parse cache should load:
+HEAVY = ['arrow', 'markdown', 'bs4', 'lxml', 'PIL', 'sqlite3',
+         'multiprocessing', 'concurrent.futures', 'http.server']
+
+SCRIPT = 'import sys; sys.argv[0] = "pyquo"; from pyquo.pyquo import main; main()'
+
+
+def run(command, home):
+    """Run a command once, returning its wall time in seconds and the
+    cumulative import time in microseconds of every module it loaded."""
+    env = dict(os.environ, HOME=home)
+    # Compiled modules are written and used, as an installed pyquo's are:
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT] + command,
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    wall = time.perf_counter() - start
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            imports[name.strip()] = int(cumulative)
+    return wall, imports
+
+
+def write_properties(home):
+    """Write the properties file the commands read, as get_properties would
+    find it under HOME."""
+    from pyquo import defaults
+    path = os.path.join(home, defaults.PROPERTIES)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(json.dumps({
+            'source_directory': os.path.join(home, 'markdown'),
+            'output_directory': os.path.join(home, 'site') + os.sep,
+            'default_author': 'Benchmark',
+            'default_browser': 'true'}))
+
+
+def heavy_imports(imports):
+    return sorted(name for name in imports
+                  if any(name == heavy or name.startswith(heavy + '.')
+                         for heavy in HEAVY))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=40,
+                        help='most milliseconds importing pyquo.pyquo may '
+                             'take (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs of each command, the fastest counting')
+    parser.add_argument('--json', default=None,
+                        help='also save the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    failures = []
+    print('{:<16} {:>10} {:>14}'.format('command', 'wall ms', 'import ms'))
+    with tempfile.TemporaryDirectory(prefix='pyquo-startup-') as home:
+        write_properties(home)
+        run(['--help'], home)
+        for command in COMMANDS:
+            runs = [run(command, home) for _ in range(args.runs)]
+            wall = min(wall for wall, imports in runs)
+            imports = min((imports for wall, imports in runs),
+                          key=lambda imports: imports.get('pyquo.pyquo', 0))
+            import_ms = imports.get('pyquo.pyquo', 0) / 1000
+            heavy = heavy_imports(imports)
+            name = ' '.join(command)
+            print('{:<16} {:>10.1f} {:>14.1f}'.format(name, wall * 1000,
+                                                      import_ms))
+            results.append({'command': name, 'wall_ms': round(wall * 1000, 1),
+                            'import_ms': import_ms, 'heavy_imports': heavy})
+            if heavy:
+                failures.append('{} imports {}'.format(name, ', '.join(heavy)))
+            if import_ms > args.budget:
+                failures.append('{} spends {:.1f} ms importing pyquo, over '
+                                'the {} ms budget'.format(name, import_ms,
+                                                          args.budget))
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({'budget_ms': args.budget, 'results': results},
+                               indent=2, sort_keys=True))
+        print('Results written to {}.'.format(args.json))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""Benchmark suite: full and no-op builds, aggregation and each emitter.
+
+For each site size a synthetic corpus is written with benchmarks.corpus and
+measured in a fresh worker process, so that the peak memory reported for a
+size is that size's alone. Only the standard library is needed beyond
+pyquo's own dependencies, and nothing touches the network.
+
+    python3 -m benchmarks.suite [--pages 1000 10000 100000] [--json FILE]
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from pyquo import pyquo
+from pyquo.templates import load_templates
+from pyquo import timing
+from pyquo import manifest
+from benchmarks import corpus
+
+PROPERTIES = {'source_directory': 'contents', 'site_title': 'Bench',
+              'css': 'style.css'}
+
+HEADER = '{:>8} {:<26} {:>10} {:>12} {:>9}'.format(
+    'pages', 'stage', 'seconds', 'pages/s', 'peak MB')
+
+
+def peak_memory():
+    """Peak resident set size in MB of this process and of any workers it
+    has waited for (Linux reports ru_maxrss in KB)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class Results(object):
+    """Seconds, throughput and peak memory so far for each stage."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.stages = {}
+
+    def add(self, stage, seconds, pages=None):
+        pages = self.pages if pages is None else pages
+        self.stages[stage] = {
+            'seconds': round(seconds, 4),
+            'pages_per_second': round(pages / seconds, 1) if seconds else None,
+            'peak_mb': round(peak_memory(), 1)}
+
+    def time(self, stage, function, *args, pages=None, **kwargs):
+        start = timing.clock()
+        result = function(*args, **kwargs)
+        self.add(stage, timing.since(start)[0], pages)
+        return result
+
+
+def emitters(results, paths, all_pages, templates):
+    """Time each emitter on its own, into the current directory."""
+    settings = ('Bench', 'index.html', 'search.html')
+    css, ts_frmt, proj_root = 'style.css', 'dddd DD MMMM, YYYY', '/'
+    # Pages are parsed one at a time and only the emitting is timed, so the
+    # rendered HTML of the whole site never has to be held at once:
+    seconds = 0.0
+    for path in paths:
+        meta = pyquo.parse_page(path)
+        if meta is None or meta.publish is not True:
+            continue
+        start = timing.clock()
+        pyquo.generate_static_page(*settings, meta, css, ts_frmt, proj_root,
+                                   templates=templates)
+        seconds += timing.since(start)[0]
+    results.add('emit pages', seconds, len(all_pages))
+
+    all_cats, tags, archives, index, word_cloud = \
+        pyquo.extract_site_wide_metadata(all_pages, log=corpus.quiet)
+    results.time('emit front and categories',
+                 pyquo.generate_front_and_category_pages, *settings,
+                 all_cats, tags, archives, word_cloud, proj_root, css,
+                 ts_frmt, 10, templates=templates, log=corpus.quiet)
+    results.time('emit search', pyquo.generate_search_page, *settings,
+                 index, css, proj_root, templates=templates,
+                 log=corpus.quiet)
+
+
+def run(pages, options, jobs, directory=None, low_memory=False):
+    """Measure one site size; runs in a worker process of its own."""
+    properties = dict(PROPERTIES, low_memory=low_memory)
+    workdir = tempfile.mkdtemp(prefix='pyquo-bench-', dir=directory)
+    cwd = os.getcwd()
+    results = Results(pages)
+    try:
+        os.chdir(workdir)
+        paths = results.time('corpus', corpus.generate_corpus, 'contents',
+                             pages, **options)
+
+        profiler = timing.Profiler()
+        results.time('build', pyquo.generate_pages, properties, jobs=jobs,
+                     profiler=profiler, log=corpus.quiet)
+        results.time('no-op build', pyquo.generate_pages, properties,
+                     jobs=jobs, log=corpus.quiet)
+        if low_memory:
+            # The emitters below need every page's words in memory:
+            return {'pages': pages, 'jobs': jobs, 'low_memory': low_memory,
+                    'stages': results.stages,
+                    'build_phases': profiler.report(slowest=0)['phases']}
+
+        # Aggregate the metadata the build saved, as a rebuild would:
+        records = manifest.load_manifest('.pyquo_manifest.json')['sources']
+        all_pages = [pyquo.load_meta(records[path]['meta']) for path in paths
+                     if records[path]['meta']['publish'] is True]
+        results.time('aggregate', pyquo.extract_site_wide_metadata,
+                     all_pages, log=corpus.quiet)
+
+        os.mkdir('emit')
+        os.chdir('emit')
+        emitters(results, [os.path.join(workdir, path) for path in paths],
+                 all_pages, load_templates())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return {'pages': pages, 'jobs': jobs, 'low_memory': low_memory,
+            'stages': results.stages,
+            'build_phases': profiler.report(slowest=0)['phases']}
+
+
+def rows(result):
+    for stage, numbers in result['stages'].items():
+        yield '{:>8} {:<26} {:>10.3f} {:>12} {:>9.1f}'.format(
+            result['pages'], stage, numbers['seconds'],
+            numbers['pages_per_second'] or '-', numbers['peak_mb'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='worker processes for the builds')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='build in low memory mode, timing the builds '
+                             'only')
+    parser.add_argument('--directory', default=None,
+                        help='build under this directory, e.g. a tmpfs')
+    parser.add_argument('--json', default=None,
+                        help='also save the results as JSON to this file')
+    corpus.add_arguments(parser)
+    args = parser.parse_args()
+
+    options = corpus.corpus_options(args)
+    report = {'version': pyquo.__version__, 'corpus': options, 'results': []}
+    print(HEADER)
+    for pages in args.pages:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run, pages, options, args.jobs,
+                                     args.directory,
+                                     args.low_memory).result()
+        report['results'].append(result)
+        for row in rows(result):
+            print(row)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True))
+        print('Results written to {}.'.format(args.json))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+# Connections are per process and thread, as sqlite connections must not be
+# shared with worker processes forked after they were opened, nor by sites
+# built in different threads:
+_caches = {}
+
+
+def open_cache(path):
+    """The ParseCache at path for this thread, opened once per thread."""
+    key = (os.path.abspath(path), os.getpid(), threading.get_ident())
+    if key not in _caches:
+        _caches[key] = ParseCache(path)
+    return _caches[key]
+
+
+def close_cache(path):
+    """Close this thread's connection to the ParseCache at path, if it has
+    one, so that a process building many sites doesn't keep them all open."""
+    key = (os.path.abspath(path), os.getpid(), threading.get_ident())
+    parse_cache = _caches.pop(key, None)
+    if parse_cache is not None:
+        parse_cache.close()
+
+
+def cache_key(text, config):
+    """Key for a source's text converted with the given configuration."""
+    digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8'))
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ParseCache(object):
+    """Converted markdown sources kept in an sqlite file between builds.
+
+    Values are anything JSON can hold, stored compressed under a key from
+    cache_key(). Each entry remembers when it was last used, so evict() can
+    drop the least recently used entries once the file outgrows its limit.
+    Worker processes each open their own connection; the database is in WAL
+    mode so they can read and write at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          isolation_level=None)
+        self.connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL);
+            CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY, value INTEGER);
+            """)
+
+    def get(self, key):
+        """The value stored under key, or None."""
+        row = self.connection.execute(
+            'SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE entries SET used = ? WHERE key = ?',
+                                (time.time(), key))
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, value):
+        data = zlib.compress(json.dumps(value).encode('utf-8'), 1)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+            (key, data, len(data), time.time()))
+
+    def count(self, **counts):
+        """Add to the running totals shown by stats(), e.g. hits=10."""
+        self.connection.executemany(
+            'INSERT INTO counters VALUES (?, ?) ON CONFLICT (name) DO '
+            'UPDATE SET value = value + excluded.value', counts.items())
+
+    def evict(self, max_size):
+        """Drop the least recently used entries until the values stored
+        take up no more than max_size bytes. Returns how many were dropped."""
+        size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        excess = size - max_size
+        if excess <= 0:
+            return 0
+        stale = []
+        for key, size in self.connection.execute(
+                'SELECT key, size FROM entries ORDER BY used'):
+            stale.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.execute('BEGIN')
+        self.connection.executemany('DELETE FROM entries WHERE key = ?',
+                                    stale)
+        self.connection.execute('COMMIT')
+        self.count(evicted=len(stale))
+        return len(stale)
+
+    def stats(self):
+        entries, size, oldest, newest = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(used), MAX(used) '
+            'FROM entries').fetchone()
+        stats = {'path': self.path, 'entries': entries, 'size': size,
+                 'file_size': sum(os.path.getsize(self.path + suffix)
+                                  for suffix in ['', '-wal']
+                                  if os.path.exists(self.path + suffix)),
+                 'oldest': oldest, 'newest': newest,
+                 'hits': 0, 'misses': 0, 'evicted': 0}
+        stats.update(self.connection.execute(
+            'SELECT name, value FROM counters'))
+        return stats
+
+    def close(self):
+        self.connection.close()
+
+    def clear(self):
+        """Drop every entry and the running totals."""
+        self.connection.execute('DELETE FROM entries')
+        self.connection.execute('DELETE FROM counters')
+        self.connection.execute('VACUUM')
@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+
+from markdown.extensions.meta import META_RE, META_MORE_RE, BEGIN_RE, END_RE
+
+# Markdown removes these and expands tabs before the meta extension runs:
+STX, ETX = '\u0002', '\u0003'
+TAB_LENGTH = 4
+
+
+def read_front_matter(path):
+    """The meta block at the top of a markdown source, as the markdown meta
+    extension would find it: lower case keys mapped to lists of values, or
+    {} if there is none. Only the lines of the block are read."""
+    meta = {}
+    key = None
+    with open(path, 'r') as f:
+        for number, line in enumerate(f):
+            line = line.rstrip('\n').replace(STX, '').replace(ETX, '')
+            line = line.expandtabs(TAB_LENGTH)
+            if number == 0 and BEGIN_RE.match(line):
+                continue
+            if line.strip() == '' or END_RE.match(line):
+                break
+            match = META_RE.match(line)
+            if match:
+                key = match.group('key').lower().strip()
+                meta.setdefault(key, []).append(match.group('value').strip())
+                continue
+            match = META_MORE_RE.match(line)
+            if not (match and key):
+                break
+            meta[key].append(match.group('value').strip())
+    return meta
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import os
+import json
+import hashlib
+
+MANIFEST_VERSION = 4
+
+
+def load_manifest(manifest_file):
+    """Load the manifest left by the previous build, or an empty one if
+    there is none or manifest_file is None."""
+    if manifest_file is not None and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            try:
+                manifest = json.loads(f.read())
+            except ValueError:
+                manifest = {}
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    return {'version': MANIFEST_VERSION, 'sources': {}, 'site': {},
+            'media': {}}
+
+
+def save_manifest(manifest, manifest_file):
+    """Write the manifest via a temporary file so a crash can't corrupt it."""
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps(manifest, sort_keys=True))
+    os.replace(tmp_file, manifest_file)
+
+
+def fingerprint(value):
+    """Stable hash of any JSON-serialisable value."""
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def check_source(path, previous_entry, exists=os.path.exists):
+    """Return (entry, changed) for a source file.
+
+    The mtime and size are compared first so that untouched files never have
+    to be read. If they differ the content hash decides, so that a file which
+    was merely touched (or checked out again) is not re-rendered. exists
+    tells whether the source's previous outputs are still there.
+    """
+    stat = os.stat(path)
+    entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if previous_entry is None:
+        entry['hash'] = file_digest(path)
+        return entry, True
+    if (previous_entry.get('mtime') == stat.st_mtime and
+            previous_entry.get('size') == stat.st_size):
+        entry['hash'] = previous_entry.get('hash')
+    else:
+        entry['hash'] = file_digest(path)
+    if entry['hash'] != previous_entry.get('hash'):
+        return entry, True
+    if not all(exists(output) for output in previous_entry.get('outputs', [])):
+        return entry, True
+    entry['outputs'] = previous_entry.get('outputs', [])
+    entry['meta'] = previous_entry.get('meta')
+    return entry, False
+
+
+def remove_stale_outputs(old_outputs, new_outputs, output):
+    """Delete the outputs the last build produced and this build did not
+    from output, an output.FileOutput or MemoryOutput."""
+    return [path for path in sorted(set(old_outputs) - set(new_outputs))
+            if output.remove(path)]
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import io
+import os
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from pyquo import manifest
+from pyquo import output
+
+# Images Pillow resizes and recompresses, by extension. Other images are
+# copied as they are, under a content-hashed name all the same:
+RESIZABLE = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+IMAGES = set(RESIZABLE).union(['.gif', '.svg'])
+
+# Where images which aren't resized are copied to in the output, for pages
+# to link them as ../media/<name>:
+COPY_DIRECTORY = 'media'
+
+
+def pillow():
+    """PIL's Image and ImageOps modules, or None if Pillow isn't installed."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    return Image, ImageOps
+
+
+def discover_images(directory):
+    """Map the name of every image under directory, as a page's HeaderImage
+    gives it, to its path."""
+    images = {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if os.path.splitext(file)[1].lower() not in IMAGES:
+                continue
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            images[name] = path
+    return images
+
+
+def build_media(directory, derived_directory, previous, widths, quality,
+                jobs=1, writer=None, log=print):
+    """Write the derivatives of every image under directory that changed
+    since the build whose media manifest entries are previous, with writer.
+
+    Returns the new entries, the names of the images whose derivatives
+    differ from last time (so pages showing them can be written again) and
+    the workers' stats. An entry's meta is what generate_static_page needs
+    to show the image: the derivatives' paths and widths, and the size of
+    the largest.
+    """
+    writer = writer or output.Writer()
+    entries = {}
+    to_build = []
+    for name, path in discover_images(directory).items():
+        entry, changed = manifest.check_source(path, previous.get(name),
+                                               writer.backend.exists)
+        entries[name] = entry
+        if changed:
+            to_build.append(name)
+    if to_build and pillow() is None:
+        log('Pillow is not installed, so images are copied without being '
+            'resized.')
+    # Workers write straight to disk, or return what they wrote for this
+    # process to write to any other output:
+    derive_image = functools.partial(
+        derive, directory=directory, derived_directory=derived_directory,
+        widths=widths, quality=quality,
+        backend=writer.backend if writer.backend.on_disk else None)
+    if jobs == 1 or len(to_build) < 2:
+        results = list(map(derive_image, to_build))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(derive_image, to_build))
+    stats = output.Writer().stats
+    for name, (record, outputs, image_stats, files) in zip(to_build, results):
+        entries[name]['meta'] = record
+        entries[name]['outputs'] = outputs
+        stats.update(image_stats)
+        for path, data in files.items():
+            writer.write(path, data)
+
+    return entries, changed_images(entries, previous), stats
+
+
+def copy_media(directory, previous, writer):
+    """Copy every image under directory that changed since the last build to
+    COPY_DIRECTORY with writer, as it is, for sites which don't resize their
+    images. Returns the same as build_media.
+
+    An image already where its copy would go, as when the site is built in
+    its own directory, is neither copied nor recorded as an output, so that
+    it can never be removed as one.
+    """
+    entries = {}
+    for name, path in discover_images(directory).items():
+        entry, changed = manifest.check_source(path, previous.get(name),
+                                               writer.backend.exists)
+        entries[name] = entry
+        target = COPY_DIRECTORY + '/' + name
+        if (writer.backend.on_disk and
+                os.path.exists(writer.backend.path(target)) and
+                os.path.samefile(writer.backend.path(target), path)):
+            changed, entry['outputs'] = True, []
+        elif changed:
+            with open(path, 'rb') as f:
+                writer.write(target, f.read())
+            entry['outputs'] = [target]
+        if changed:
+            entry['meta'] = {'src': target, 'srcset': [], 'width': None,
+                             'height': None}
+
+    return entries, changed_images(entries, previous), output.Writer().stats
+
+
+def changed_images(entries, previous):
+    """Names of the images shown differently than in the last build."""
+    return set(name for name in set(entries).union(previous)
+               if (entries.get(name, {}).get('meta') !=
+                   previous.get(name, {}).get('meta')))
+
+
+def derive(name, directory, derived_directory, widths, quality,
+           backend=None):
+    """Return (record, outputs, stats, files) for one image, writing a copy
+    of it resized to each of widths narrower than it, and one no wider than
+    the widest of them. Without a backend to write to, the copies are
+    returned in files."""
+    writer = output.Writer(backend or output.MemoryOutput())
+    with open(os.path.join(directory, name), 'rb') as f:
+        data = f.read()
+    stem, extension = os.path.splitext(name)
+    image_format = RESIZABLE.get(extension.lower())
+    modules = pillow()
+    if image_format is None or modules is None:
+        src = save(writer, derived_directory, stem, extension, data)
+        return {'src': src, 'srcset': [], 'width': None, 'height': None},\
+            [src], writer.stats, returned(writer, backend)
+
+    Image, ImageOps = modules
+    with Image.open(io.BytesIO(data)) as original:
+        # Photos are often stored sideways with an EXIF orientation tag:
+        image = ImageOps.exif_transpose(original)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        sizes = sorted(set(width for width in widths if width < image.width)
+                       .union([min(image.width, max(widths))]))
+        srcset = []
+        for width in sizes:
+            height = max(1, round(image.height * width / image.width))
+            resized = image if width == image.width else image.resize(
+                (width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            if image_format == 'PNG':
+                resized.save(buffer, image_format, optimize=True)
+            else:
+                resized.save(buffer, image_format, quality=quality,
+                             optimize=True, progressive=True)
+            srcset.append([save(writer, derived_directory,
+                                '{}-{}'.format(stem, width), extension,
+                                buffer.getvalue()), width])
+    return {'src': srcset[-1][0], 'srcset': srcset, 'width': sizes[-1],
+            'height': height}, [path for path, width in srcset], \
+        writer.stats, returned(writer, backend)
+
+
+def returned(writer, backend):
+    """The files derive() has to return: none if it wrote to backend."""
+    return {} if backend is not None else output.collected(writer)
+
+
+def save(writer, derived_directory, stem, extension, data):
+    """Write data under a name holding a hash of its content, so that it
+    can be cached for ever, and return the path."""
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    path = os.path.join(derived_directory, '{}.{}{}'.format(
+        stem, digest, extension.lower()))
+    writer.write(path, data)
+    return path
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import io
+import os
+import gzip
+import time
+import functools
+import itertools
+from collections import Counter
+from pyquo import utils
+from pyquo import timing
+
+# Outputs worth serving precompressed; images are compressed already:
+COMPRESSIBLE = ('.html', '.json', '.css', '.xml', '.js', '.svg')
+
+
+class Writer(object):
+    """Write build outputs, leaving any file whose content hasn't changed
+    untouched so that its mtime survives and rsync or a CDN can skip it.
+
+    Files go to backend, a FileOutput for the current directory unless
+    another FileOutput, MemoryOutput or ArchiveOutput is given.
+
+    stats counts the files and bytes written and skipped, and the wall and
+    CPU seconds spent checking and writing them. It is a Counter so the
+    stats of pages built in worker processes can simply be added up.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else FileOutput()
+        self.stats = Counter()
+
+    def write(self, path, text):
+        """Write text, or bytes, to path unless it already holds it; returns
+        whether the file was written."""
+        start = timing.clock()
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        written = not self.backend.holds(path, data)
+        if written:
+            self.backend.write(path, data)
+            self.stats['written'] += 1
+            self.stats['written_bytes'] += len(data)
+        else:
+            self.stats['skipped'] += 1
+            self.stats['skipped_bytes'] += len(data)
+        wall, cpu = timing.since(start)
+        self.stats['write_wall'] += wall
+        self.stats['write_cpu'] += cpu
+        return written
+
+    def report(self):
+        return ('{written} files written ({written_bytes} bytes), {skipped} '
+                'unchanged files skipped ({skipped_bytes} bytes).'
+                .format(**{key: self.stats[key] for key in [
+                    'written', 'written_bytes', 'skipped', 'skipped_bytes']}))
+
+
+# The stats a Writer keeps about writing, as opposed to those callers add:
+WRITE_STATS = ['written', 'written_bytes', 'skipped', 'skipped_bytes',
+               'write_wall', 'write_cpu']
+
+
+def collected(writer):
+    """The files a worker process wrote to a MemoryOutput, for the parent
+    process to write to a backend only it can reach. The worker's writing
+    stats are dropped, as the parent counts the files when it writes them."""
+    for key in WRITE_STATS:
+        writer.stats.pop(key, None)
+    return writer.backend.files
+
+
+class FileOutput(object):
+    """Outputs written as files under directory. Worker processes write to
+    it directly, and the manifest is kept next to the sources between
+    builds."""
+
+    on_disk = True
+    readable = True
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def holds(self, name, data):
+        """True if name already holds exactly data. Only files of the same
+        size are read back, so changed pages cost a stat call at most."""
+        path = self.path(name)
+        try:
+            if os.path.getsize(path) != len(data):
+                return False
+            with open(path, 'rb') as f:
+                return f.read() == data
+        except OSError:
+            return False
+
+    def write(self, name, data):
+        path = self.path(name)
+        utils.mkdir(os.path.dirname(path))
+        utils.write_file(path, data)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def modified(self, name):
+        """When name was last written, comparable with other outputs', or
+        None if it doesn't exist."""
+        try:
+            return os.stat(self.path(name)).st_mtime_ns
+        except OSError:
+            return None
+
+    def remove(self, name):
+        """Delete name, and its directory if that is left empty; returns
+        whether there was anything to delete."""
+        path = self.path(name)
+        removed = os.path.exists(path)
+        if removed:
+            os.remove(path)
+        if os.path.dirname(name):
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        return removed
+
+    def close(self):
+        pass
+
+
+class MemoryOutput(object):
+    """Outputs kept in memory, in files, a dict of names to bytes, e.g. to
+    be served straight from memory or looked at in tests. Build into the
+    same MemoryOutput again and only what changed is rewritten."""
+
+    on_disk = False
+    readable = True
+
+    def __init__(self):
+        self.files = {}
+        self.stamps = {}
+        self.clock = itertools.count()
+
+    def holds(self, name, data):
+        return self.files.get(name) == data
+
+    def write(self, name, data):
+        self.files[name] = data
+        self.stamps[name] = next(self.clock)
+
+    def read(self, name):
+        return self.files[name]
+
+    def exists(self, name):
+        return name in self.files
+
+    def modified(self, name):
+        return self.stamps.get(name)
+
+    def remove(self, name):
+        self.stamps.pop(name, None)
+        return self.files.pop(name, None) is not None
+
+    def close(self):
+        pass
+
+
+class ArchiveOutput(object):
+    """Outputs streamed into a new zip or tar archive, written to target, a
+    path or a binary file object, as they are built. format is 'zip', 'tar'
+    or 'tar.gz'; call close() once the build is done.
+
+    There is nothing to compare with or remove, so build into an archive
+    from scratch, without the previous build's manifest. Outputs can't be
+    read back, so they can't be precompressed either.
+    """
+
+    on_disk = False
+    readable = False
+
+    def __init__(self, target, format='zip'):
+        # Only imported when archiving, as pyquo's commands start faster
+        # without them:
+        import tarfile
+        import zipfile
+        self.format = format
+        self.names = set()
+        # Every member is dated when the archive was started:
+        self.time = time.time()
+        if format == 'zip':
+            self.archive = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            mode = 'w:gz' if format == 'tar.gz' else 'w'
+            if isinstance(target, str):
+                self.archive = tarfile.open(target, mode)
+            else:
+                self.archive = tarfile.open(fileobj=target, mode=mode)
+
+    def holds(self, name, data):
+        return False
+
+    def write(self, name, data):
+        import tarfile
+        import zipfile
+        # A name written again is added again, and extracting the archive
+        # leaves the later member, as the last write wins on disk:
+        self.names.add(name)
+        if self.format == 'zip':
+            member = zipfile.ZipInfo(
+                name, time.localtime(self.time)[:6])
+            member.compress_type = zipfile.ZIP_DEFLATED
+            member.external_attr = 0o644 << 16
+            self.archive.writestr(member, data)
+        else:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = self.time
+            member.mode = 0o644
+            self.archive.addfile(member, io.BytesIO(data))
+
+    def exists(self, name):
+        return name in self.names
+
+    def modified(self, name):
+        return None
+
+    def remove(self, name):
+        return False
+
+    def close(self):
+        self.archive.close()
+
+
+def brotli_module():
+    """The brotli module, or None if it isn't installed."""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def precompress(paths, jobs=1, backend=None):
+    """Write a .gz sibling, and a .br one if brotli is installed, next to
+    each of paths in backend (by default the current directory) for a web
+    server to send as they are.
+
+    Siblings newer than their file are left alone, so only files written
+    since the last build are compressed. Returns the paths of every sibling
+    and how many files were compressed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    backend = backend if backend is not None else FileOutput()
+    extensions = ['.gz'] + (['.br'] if brotli_module() is not None else [])
+    siblings = []
+    stale = []
+    for path in paths:
+        siblings.extend(path + extension for extension in extensions)
+        modified = backend.modified(path)
+        if not all(backend.modified(path + extension) is not None and
+                   backend.modified(path + extension) >= modified
+                   for extension in extensions):
+            stale.append(path)
+    if not backend.on_disk:
+        for path in stale:
+            data = backend.read(path)
+            for extension in extensions:
+                backend.write(path + extension, compress(data, extension))
+    else:
+        files = functools.partial(compress_file, extensions=extensions)
+        paths = [backend.path(path) for path in stale]
+        if jobs == 1 or len(paths) < 2:
+            list(map(files, paths))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(files, paths,
+                                  chunksize=max(1, len(paths) // (jobs * 4))))
+    return siblings, len(stale)
+
+
+def compress(data, extension):
+    if extension == '.gz':
+        # No timestamp in the header, so the same file compresses to the
+        # same bytes every time:
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli_module().compress(data)
+
+
+def compress_file(path, extensions):
+    with open(path, 'rb') as f:
+        data = f.read()
+    for extension in extensions:
+        utils.write_file(path + extension, compress(data, extension))
@@ -4,323 +4,733 @@ import os
 import re
 import sys
 import json
-import arrow
 import argparse
-import markdown
+import functools
 import unicodedata
 from pyquo import utils
-from pprint import pprint
-from subprocess import Popen
-from datetime import datetime
-from bs4 import BeautifulSoup
-from collections import namedtuple
+from pyquo import output
+from pyquo import search
+from pyquo import timing
+from pyquo import __version__
+from pyquo.templates import default_templates
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from collections import Counter
+
+# arrow, markdown, subprocess, worker pools and the modules needing them are
+# imported by the functions which use them, so that commands such as new and
+# properties start without loading them, as benchmarks.startup checks.
 
 EPILOG = """
 Set properties in {}
 """.format(utils.DEFAULT_PROPERTIES_FILE)
 
 
-def generate_pages(properties):
-    proj_root = properties.get('root', '/')
-    homepage = properties.get('homepage', 'index.html')
-    searchpage = properties.get('searchpage', 'search.html')
-    site_title = properties.get('site_title', 'PyQuo')
-    ts_frmt = properties.get('timestamp_format', 'dddd DD MMMM, YYYY')
-    directory = properties.get('source_directory', 'markdown')
-    media_directory = properties.get('media_directory', 'media')
-    css = properties.get('css')
-    entries_to_show = properties.get('entries_to_show', 10)
-    parser = properties.get('beautiful_soup_parser', 'lxml')
-
-    all_pages = []
-    categories = []
-    count = 0
+def generate_pages(properties, jobs=1, old_manifest=None,
+                   on_pages_written=None, profiler=None, categories=None,
+                   exclude=None, root=None, backend=None, log=print):
+    """Build the site once, incrementally, returning the new manifest. See
+    site.Site, which does the work, for the arguments.
 
+    A long running caller can pass the manifest returned by the previous
+    build instead of having it read back from disk, though keeping a
+    site.Site, as watch does, also spares a rebuild looking at every source.
+    """
+    from pyquo.site import Site
+    site = Site(properties, root, backend, log)
+    site.manifest = old_manifest
+    site.build(jobs, categories, exclude, profiler, on_pages_written)
+    return site.manifest
+
+
+def normalise_categories(categories):
+    """Category names as pages are filed under them, or None if none are
+    given."""
+    if not categories:
+        return None
+    return {category.replace(" ", "").lower() for category in categories}
+
+
+def selected(page_categories, only=None, exclude=None):
+    """Whether a page filed under page_categories is part of a build of only
+    some categories, or of all but the excluded ones."""
+    if only is not None and only.isdisjoint(page_categories):
+        return False
+    if exclude is not None and exclude.issuperset(page_categories):
+        return False
+    return True
+
+
+def discover_sources(directory):
+    """List every markdown source under directory, in a stable order."""
+    sources = []
     for root, dirs, files in os.walk(directory):
-        valid_files = [file for file in files if not
-                       (file.endswith('~') or file.startswith('.'))]
-
-        for valid_file in valid_files:
-            with open(os.path.join(root, valid_file), 'r') as input_file:
-                md = markdown.Markdown(extensions=['markdown.extensions.meta'])
-                markdown_text = input_file.read()
-                html = md.convert(markdown_text)
-                text = ''.join(BeautifulSoup(html, parser).findAll(text=True))
-            if md.Meta == {}:
-                continue
-
-            meta = namedtuple('meta', [])
-            meta.title = md.Meta['title'][0]
-            meta.slug = utils.slugify(meta.title)
-            meta.categories = [
-                category for category in set([cat.replace(" ", "").lower()
-                for cat in md.Meta['category'][0].split(',')])]
-            meta.authors = md.Meta['authors'][0]
-            meta.date = md.Meta['date'][0]
-            meta.tags = md.Meta['tags'][0].split(',')
-            meta.header_image = md.Meta['headerimage'][0]
-            meta.publish = True if md.Meta['publish'][0].lower() in [
-                'true', 'yes'] else False
-            meta.content = html
-            meta.index = re.findall("\w+", text.lower())
-            categories.extend(meta.categories)
-
-            if meta.publish is True:
-                generate_static_page(site_title, homepage, searchpage, meta,
-                                     css, ts_frmt, proj_root)
-                all_pages.append(meta)
-                count += 1
-        all_cats = [category for category in set(categories)]
-        print('{} pages generated with the following categories: {}.'
-              .format(count, ', '.join(all_cats)))
-        all_cats, tags, chronology, index, word_cloud =\
-            extract_site_wide_metadata(all_pages)
-        generate_front_and_category_pages(site_title, homepage, searchpage, all_cats, tags,
-                            chronology, word_cloud, proj_root, css, ts_frmt,
-                            entries_to_show)
-        generate_search_page(site_title, homepage, searchpage, index, css,
-                             proj_root)
+        dirs.sort()
+        sources.extend(os.path.join(root, file) for file in sorted(files)
+                       if not (file.endswith('~') or file.startswith('.')))
+    return sources
+
+
+def build_pages(paths, parser, page_args, jobs=1, cache_file=None,
+                backend=None, shadowed=None):
+    """Parse and render each source, in worker processes if jobs > 1.
+
+    Pages are written to backend, by default the current directory, and
+    only the compact metadata and the list of written files come back from
+    each page, never the rendered HTML, unless backend isn't on disk: then
+    the files come back too, for the caller to write. Results are yielded
+    in the order of paths, as they become available, so the output is
+    identical however many jobs are used. Conversions are looked up in and
+    added to the parse cache at cache_file, if given. shadowed lists, for
+    each of paths, the files left to another page with the same name.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if backend is None:
+        backend = output.FileOutput()
+    build = functools.partial(build_page, parser=parser, page_args=page_args,
+                              cache_file=cache_file,
+                              backend=backend if backend.on_disk else None)
+    if shadowed is None:
+        shadowed = [[] for path in paths]
+    if jobs == 1 or len(paths) < 2:
+        yield from map(build, paths, shadowed)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        yield from executor.map(build, paths, shadowed, chunksize=chunksize)
+
+
+def build_page(path, shadowed, parser, page_args, cache_file=None,
+               backend=None):
+    """Return (meta record, outputs, stats, files) for a single source. The
+    stats are the writer's plus the wall and CPU time spent parsing and
+    rendering the page and whether the parse cache had it. Without a
+    backend to write to, the page's files are returned in files instead.
+    The files in shadowed are left to other pages."""
+    from pyquo.cache import open_cache
+    start = timing.clock()
+    writer = output.Writer(backend or output.MemoryOutput())
+    cache = open_cache(cache_file) if cache_file else None
+    meta = parse_page(path, parser, cache, writer.stats)
+    writer.stats['parse_wall'], writer.stats['parse_cpu'] = timing.since(start)
+    if meta is None:
+        return None, [], writer.stats, {}
+    outputs = []
+    if meta.publish is True:
+        (site_title, homepage, searchpage, css, ts_frmt, proj_root,
+         templates, images) = page_args
+        start = timing.clock()
+        outputs = generate_static_page(site_title, homepage, searchpage, meta,
+                                       css, ts_frmt, proj_root,
+                                       templates=templates, writer=writer,
+                                       images=images, shadowed=shadowed)
+        wall, cpu = timing.since(start)
+        writer.stats['render_wall'] = wall - writer.stats['write_wall']
+        writer.stats['render_cpu'] = cpu - writer.stats['write_cpu']
+    files = output.collected(writer) if backend is None else {}
+    return dump_meta(meta), outputs, writer.stats, files
+
+
+MARKDOWN_EXTENSIONS = ['markdown.extensions.meta']
+
+
+def parse_page(path, parser=None, cache=None, stats=None):
+    """Convert a markdown source, returning its metadata or None if the
+    source has no meta block. Pass a BeautifulSoup parser name to extract
+    the text with bs4 instead of utils.html_to_text.
+
+    Given a cache.ParseCache, the conversion is looked up there by the
+    source's content and only done on a miss; stats, a Counter, then counts
+    cache_hits and cache_misses.
+    """
+    import markdown
+    from pyquo.cache import cache_key
+    with open(path, 'r') as input_file:
+        markdown_text = input_file.read()
+    converted = None
+    if cache is not None:
+        key = cache_key(markdown_text, [__version__, markdown.__version__,
+                                        MARKDOWN_EXTENSIONS, parser])
+        converted = cache.get(key)
+        if stats is not None:
+            stats['cache_hits' if converted else 'cache_misses'] += 1
+    if converted is None:
+        converted = convert_markdown(markdown_text, parser)
+        if cache is not None:
+            cache.put(key, converted)
+    html, md_meta, words = converted
+    if md_meta == {}:
+        return None
+    meta = page_meta(md_meta)
+    meta.content = html
+    meta.index = Counter(words)
+    return meta
+
+
+def page_meta(md_meta):
+    """The metadata of a page from its meta block, without its content or
+    search index words, which take converting the whole source."""
+    meta = SimpleNamespace()
+    meta.title = md_meta['title'][0]
+    meta.slug = utils.slugify(meta.title)
+    # De-duplicate in the order written rather than through a set, whose
+    # order varies between processes and would make parallel builds differ:
+    meta.categories = []
+    for cat in md_meta['category'][0].split(','):
+        category = cat.replace(" ", "").lower()
+        if category not in meta.categories:
+            meta.categories.append(category)
+    meta.authors = md_meta['authors'][0]
+    meta.date = md_meta['date'][0]
+    meta.tags = md_meta['tags'][0].split(',')
+    meta.header_image = md_meta['headerimage'][0]
+    meta.publish = True if md_meta['publish'][0].lower() in [
+        'true', 'yes'] else False
+    return meta
+
+
+def convert_markdown(markdown_text, parser=None):
+    """Return the HTML, meta block and indexable word counts of a source,
+    everything parse_page needs that is worth caching."""
+    import markdown
+    md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    html = md.convert(markdown_text)
+    if parser is None:
+        text = utils.html_to_text(html)
+    else:
+        from bs4 import BeautifulSoup
+        text = ''.join(BeautifulSoup(html, parser).findAll(text=True))
+    words = Counter(word for word in re.findall("\w+", text.lower())
+                    if search.indexable(word))
+    return html, md.Meta, words
+
+
+# Everything about a page that the site-wide pages need, so that unchanged
+# sources can be restored from the manifest without being converted again:
+META_FIELDS = ['title', 'slug', 'categories', 'authors', 'date', 'tags',
+               'header_image', 'publish', 'index']
+
+
+class PageRecord(object):
+    """The metadata kept for every page until the end of a build. It has no
+    rendered HTML, and pages share their category and tag strings."""
+
+    __slots__ = META_FIELDS
+
+
+def dump_meta(meta):
+    return {field: getattr(meta, field) for field in META_FIELDS}
+
+
+def load_meta(record):
+    meta = PageRecord()
+    for field in META_FIELDS:
+        setattr(meta, field, record[field])
+    meta.categories = tuple(sys.intern(category)
+                            for category in record['categories'])
+    meta.tags = tuple(sys.intern(tag) for tag in record['tags'])
+    return meta
 
 
 def extract_site_wide_metadata(all_pages, key='index_and_tags',
-                               ignore_threshold_percentage=40):
+                               max_document_frequency=0.4,
+                               stop_words=search.STOP_WORDS, index=None,
+                               dates=None, chronology=None, log=print):
     """Get site-wide metadata.
 
-    - Arrange titles by inverse date order, with link to location.
+    - Arrange titles by inverse date order, with link to location, for
+      each category.
     - Generate tag cloud (dict of tag and number of times used).
     - Generate calendar so can click on a date and get link.
+    - Build the search index, one entry per page linking to its first
+      category, in index if given or else a new search.SearchIndex.
+
+    Page dates are parsed into dates, and the entries of every category
+    gathered in chronology, if given, so that the feeds and sitemap can
+    reuse the dates and a rebuild can update the archives.
     """
 
     categories = []
     tags = {}
-    chronology = {}
-    index = {}
-    for page in all_pages:
-        for cat in page.categories:
-            category = cat.lower()
+    chronology = {} if chronology is None else chronology
+    dates = {} if dates is None else dates
+    if index is None:
+        index = search.SearchIndex(stop_words, max_document_frequency)
+    for sequence, page in enumerate(all_pages):
+        for tag in page_tags(page):
+            if tag not in tags:
+                tags[tag] = 1
+            else:
+                tags[tag] += 1
+
+        for category in page.categories:
+            category = category.lower()
             if category not in categories:
                 categories.append(category)
+        chronology[chronology_key(page, sequence, dates)] = \
+            chronology_entries(page)
+
+        index.add(search_link(page), page.title, *search_terms(page, key))
+
+    archives = order_archives(chronology, categories)
+
+    exclude_from_index = index.prune()
+    log("Excluding the following common words from search index:\n{}"
+        .format(", ".join(exclude_from_index)))
+    word_cloud = sorted(index.document_frequencies(), key=lambda x: x[1],
+                        reverse=True)
+
+    return categories, tags, archives, index, word_cloud
+
+
+def page_tags(page):
+    return [tag.strip().lower() for tag in page.tags]
+
+
+def chronology_key(page, sequence, dates):
+    """A (datetime, sequence, slug) key, which is unique to the page so no
+    probing for a free timestamp is needed. Pages sharing a date are told
+    apart by the order they were found in, so the most recently listed
+    sorts first as it always has."""
+    return (parse_date(page.date, dates).datetime, sequence, page.slug)
+
+
+def chronology_entries(page):
+    """The archive entry of a page for each of its categories."""
+    return {category.lower(): (page.title, "{}/{}.html".format(
+        category.lower(), page.slug), page.date)
+        for category in page.categories}
+
+
+def order_archives(chronology, categories):
+    """Order each category's entries once, newest first, rather than every
+    time a front or category page is written."""
+    archives = {category: [] for category in categories}
+    for page_key, cat_dict in sorted(chronology.items(), reverse=True):
+        for category, entry in cat_dict.items():
+            archives[category].append(entry)
+    return archives
+
+
+def search_link(page):
+    """The page the search index links to: its first category's copy."""
+    return "{}/{}.html".format(page.categories[0].lower(), page.slug)
+
+
+def search_terms(page, key='index_and_tags'):
+    """The word counts and tags of a page to index, as key chooses."""
+    tags_only = [tag.lower().strip() for tag in page.tags if tag != ""]
+    search_page_type = {
+        'index_only': (page.index, []),
+        'tags_only': ({}, tags_only),
+        'index_and_tags': (page.index, tags_only)}
+    return search_page_type[key]
+
+
+def parse_date(date, dates):
+    """Parse a page date, once for each distinct string in a build. Pages
+    without a date are treated as written now."""
+    import arrow
+    if date not in dates:
+        dates[date] = get_arrow(date) if date != '' else arrow.now()
+    return dates[date]
+
+
+# Pages are rendered, in whichever process, before the site-wide pages parse
+# their dates again, so each process parses a date string only once:
+@functools.lru_cache(maxsize=65536)
+def get_arrow(date):
+    """arrow.get for a page date, skipping arrow's slow parser for the ISO
+    dates that create_entry writes."""
+    import arrow
+    try:
+        parsed = datetime.fromisoformat(date)
+    except ValueError:
+        return arrow.get(date)
+    return arrow.Arrow.fromdatetime(parsed, parsed.tzinfo or timezone.utc)
 
-            for _tag in page.tags:
-                tag = _tag.strip().lower()
-                if tag not in tags:
-                    tags[tag] = 1
-                else:
-                    tags[tag] += 1
-
-
-            if page.date not in chronology:
-                link = "{}/{}.html".format(category, page.slug)
-
-                if page.date != '':
-                    timestamp = arrow.get(page.date)
-                else:
-                    timestamp = arrow.now()
-                add_to_chronology_dict(
-                    chronology, category, timestamp, (page.title, link))
-
-            tags_only = [tag.lower().strip() for tag in page.tags if tag != ""]
-            idx_words = [idx_word for idx_word in page.index if
-                         idx_word[0].isdigit() is False and len(idx_word) > 2
-                         and '_' not in idx_word]
-            search_page_type = {
-                'index_only': idx_words,
-                'tags_only': tags_only,
-                'index_and_tags': idx_words + tags_only}
-
-            for idx in sorted(search_page_type[key]):
-                word = idx.strip()
-                timestamped_entry = chronology[timestamp].get(category)
-                if timestamped_entry is None:
-                    continue
-                link = timestamped_entry[1]
-                if word not in index:
-                    index[word] = [link]
-                else:
-                    if link not in index[word]:
-                        index[word].append(link)
-
-    # Exclude links that feature in more than a certain percentage of entries:
-    threshold = (len(all_pages) / 100) * ignore_threshold_percentage
-    exclude_from_index = []
-    for word, entries in index.items():
-        if (len(entries) > threshold) and (word not in tags):
-            exclude_from_index.append(word)
-    for common_word in exclude_from_index:
-        index.pop(common_word)
-    print("Excluding the following common words from search index:\n{}"
-          .format(", ".join(sorted(exclude_from_index))))
-    words_used = [(idx, len(index[idx])) for idx in index]
-    word_cloud = sorted(words_used, key=lambda x: x[1], reverse=True)
-
-    return categories, tags, chronology, index, word_cloud
-
-
-def add_to_chronology_dict(chronology, category, timestamp, value):
-    if timestamp in chronology:
-        for num in range(1, 3600):
-            one_second_later = timestamp.replace(seconds =+ num)
-            if one_second_later not in chronology:
-                timestamp = one_second_later
-                break
-    if timestamp not in chronology:
-        chronology[timestamp] = {}
-    chronology[timestamp][category] = value
 
 def generate_front_and_category_pages(site_title, homepage, searchpage,
-                                      categories, tags, chronology, word_cloud,
+                                      categories, tags, archives, word_cloud,
                                       proj_root, css, ts_frmt,
-                                      entries_to_show):
-    generate_front_or_cat_page(site_title, homepage, searchpage, categories,
-                               tags, chronology, word_cloud, proj_root, css,
-                               ts_frmt, entries_to_show)
+                                      entries_to_show, entries_per_page=50,
+                                      templates=None, writer=None,
+                                      front_page=True, only=None, log=print):
+    """Write the front page, unless front_page is False, and the archive
+    pages of each category, or only of those listed in only."""
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    if front_page:
+        generate_front_or_cat_page(site_title, homepage, searchpage,
+                                   categories, tags, archives, word_cloud,
+                                   proj_root, css, ts_frmt, entries_to_show,
+                                   templates=templates, writer=writer,
+                                   log=log)
 
     for cat in categories:
+        if only is not None and cat not in only:
+            continue
         page_title = site_title + ' - ' + cat
-        generate_front_or_cat_page(page_title, homepage, searchpage, [cat],
-                                   tags, chronology, word_cloud, proj_root, css,
-                                   ts_frmt, cat_page=True)
-
+        pages = category_pages(cat, len(archives[cat]), entries_per_page)
+        for number in range(1, len(pages) + 1):
+            generate_front_or_cat_page(page_title, homepage, searchpage, [cat],
+                                       tags, archives, word_cloud, proj_root,
+                                       css, ts_frmt, entries_per_page,
+                                       cat_page=True, page_number=number,
+                                       page_count=len(pages),
+                                       templates=templates, writer=writer,
+                                       log=log)
+
+
+def category_pages(category, entry_count, entries_per_page):
+    """Paths of a category's archive: index.html, then page/2.html, ..."""
+    page_count = max(1, -(-entry_count // entries_per_page))
+    return [category + '/index.html'] + [
+        '{}/page/{}.html'.format(category, number)
+        for number in range(2, page_count + 1)]
+
+
+def category_page_link(from_number, to_number):
+    """Relative link between two pages of the same category archive."""
+    if to_number == 1:
+        return 'index.html' if from_number == 1 else '../index.html'
+    if from_number == 1:
+        return 'page/{}.html'.format(to_number)
+    return '{}.html'.format(to_number)
 
 
 def generate_front_or_cat_page(site_title, homepage, searchpage, categories, tags,
-                        chronology, word_cloud, proj_root, css, ts_frmt,
-                        entries_to_show=10, cat_page=False):
-    this_page = categories[0] + '/index.html' if cat_page else homepage
-    with open(this_page, 'w') as op_file:
-        print('<html>', file=op_file)
-        print('    <header>', file=op_file)
-        print('    <h3>{}</h3>'.format(site_title), file=op_file)
-        print('        <nav>', file=op_file)
-        print('<a href="{0}{1}">Home</a> | <a href="{0}{2}">Search</a>'
-              .format(proj_root, homepage, searchpage), file=op_file)
-        print('        </nav>', file=op_file)
-        print('        <link rel="stylesheet" type="text/css" media="screen"' +
-              ' href="{}" />'.format(css), file=op_file)
-        print('        <title>{}</title>'.format(site_title), file=op_file)
-        print('    </header>', file=op_file)
-        print('    <body>', file=op_file)
-
-        for cat in sorted(categories, reverse=True):
-            show_more_link = True
-            category = cat.lower()
-            print('<h2>{}</h2>'.format(category), file=op_file)
-            print('    <ul>', file=op_file)
-
-            count = 0
-            for timestamp, cat_dict in sorted(chronology.items(),
-                                                   reverse=True):
-                for _, (title, link) in cat_dict.items():
-                    if category == link.split('/')[0]:
-                        if (cat_page is True) or (count < int(entries_to_show)):
-                            if cat_page is True:
-                                link = link.split('/')[1]
-                            print('<li><a href="{}">{}</a></li>'
-                                  .format(link, title), file=op_file)
-                        elif show_more_link:
-                            show_more_link = False
-                            print('<li><a href="{}/index.html">more...</a></li>'
-                                  .format(category), file=op_file)
-                        count += 1
-            print('    </ul>', file=op_file)
-
-        # TODO: Add some kind of javascript tag-cloud, word-cloud and category
-        # list here.
-
-        print('    </body>', file=op_file)
-        print('</html>', file=op_file)
-
-    print(this_page + ' generated.')
+                        archives, word_cloud, proj_root, css, ts_frmt,
+                        entries_to_show=10, cat_page=False, page_number=1,
+                        page_count=1, templates=None, writer=None, log=print):
+    """Write the front page, listing the latest entries_to_show entries of
+    each category, or one page of a category's archive."""
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    if cat_page:
+        this_page = category_pages(categories[0], 0, 1)[0] \
+            if page_number == 1 else '{}/page/{}.html'.format(
+                categories[0], page_number)
+    else:
+        this_page = homepage
+    sections = []
+    for cat in sorted(categories, reverse=True):
+        category = cat.lower()
+        entries = archives[category]
+        rendered = []
+
+        # Archives are newest first, so each page is a single slice:
+        first = (page_number - 1) * int(entries_to_show)
+        for title, link, date in entries[first:first + int(entries_to_show)]:
+            if cat_page is True:
+                link = link.split('/')[1]
+                if page_number > 1:
+                    link = '../' + link
+            rendered.append(templates['list_entry.html'].substitute(
+                link=link, title=title))
+        if cat_page is False and len(entries) > int(entries_to_show):
+            rendered.append(templates['more_link.html'].substitute(
+                category=category))
+        sections.append(templates['list_section.html'].substitute(
+            category=category, entries=''.join(rendered)))
+
+    pagination = ''
+    if page_count > 1:
+        links = []
+        if page_number > 1:
+            links.append(templates['newer_link.html'].substitute(
+                link=category_page_link(page_number, page_number - 1)))
+        links.append('page {} of {}'.format(page_number, page_count))
+        if page_number < page_count:
+            links.append(templates['older_link.html'].substitute(
+                link=category_page_link(page_number, page_number + 1)))
+        pagination = templates['pagination.html'].substitute(
+            links=' | '.join(links))
+
+    # TODO: Add some kind of javascript tag-cloud, word-cloud and category
+    # list here.
+
+    writer.write(this_page, templates['list.html'].substitute(
+        site_title=site_title, root=proj_root, homepage=homepage,
+        searchpage=searchpage, css=css, sections=''.join(sections),
+        pagination=pagination))
+    log(this_page + ' generated.')
+
+
+# Terms are sharded by their first few characters; anything outside a-z0-9
+# maps to '_' so shard names are always safe file names. The search page's
+# script must derive shard names the same way.
+SEARCH_PAGES_PER_FILE = 1000
+
+
+def search_shard(term, prefix_length):
+    return re.sub('[^a-z0-9]', '_', term[:prefix_length])
+
+
+def term_frequencies(postings):
+    """A term's postings as a flat list of page number and frequency pairs,
+    in page order."""
+    frequencies = []
+    for number in sorted(postings):
+        frequencies.extend([number, postings[number]])
+    return frequencies
 
 
 def generate_search_page(site_title, homepage, searchpage, index, css,
-                         proj_root):
-    with open(searchpage, 'w') as op_file:
-        print('<html>', file=op_file)
-        print('    <header>', file=op_file)
-        print('    <h3>{}</h3>'.format(site_title), file=op_file)
-        print('        <nav>', file=op_file)
-        print('        <link rel="stylesheet" type="text/css" media="screen"' +
-              ' href="{}" />'.format(css), file=op_file)
-        print('        <title>Search</title>', file=op_file)
-        print('<a href="{0}{1}">Home</a> | <a href="{0}{2}">Search</a>'
-              .format(proj_root, homepage, searchpage), file=op_file)
-        print('        </nav>', file=op_file)
-        print('    </header>', file=op_file)
-        print('    <body>', file=op_file)
-
-        print('    <ul>', file=op_file)
-        for word, links in sorted(index.items()):
-            print('    <li><b><a name="{0}">{0}</a></b>'.format(word),
-                  file=op_file)
-            print('        <ul>', file=op_file)
-            for link in links:
-                print('        <li><a href="{0}">{0}</a></li>'.format(link),
-                      file=op_file)
-            print('        </ul>', file=op_file)
-        print('    </ul>', file=op_file)
-
-        print('    </body>', file=op_file)
-        print('</html>', file=op_file)
-
-        # TODO: Add some javascript wizardry so this displays a search box and
-        # only presents the list of pages when that word is entered into the
-        # box (everything else should be hidden).
-
-    print(searchpage + ' generated.')
+                         proj_root, search_dir='search', prefix_length=2,
+                         templates=None, writer=None, changed_terms=None,
+                         changed_pages=None, log=print):
+    """Write the search index as JSON shards plus a small search page.
+
+    Pages are listed in tables of SEARCH_PAGES_PER_FILE (link, title,
+    length) triples. Each shard maps the terms sharing a prefix to a flat
+    list of page number and term frequency pairs, and the page's script
+    ranks results with BM25 from those: scores stored in the shards would
+    depend on every page, so one edit would rewrite them all. The page only
+    fetches the shard and tables a query needs, so it has to be served over
+    HTTP rather than opened as a file.
+
+    After an edit, pass the terms whose postings changed and the numbers of
+    the pages which changed, and a search.SearchIndex only writes the
+    shards and tables holding those, though every path is still returned.
+    """
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    outputs = []
+
+    def write_shard(name, terms):
+        outputs.append(os.path.join(search_dir, name + '.json'))
+        if changed_terms is None or name in changed_shards:
+            write_json(outputs[-1], terms, writer)
+
+    if changed_terms is None:
+        # Terms arrive in order, so a shard named after a prefix is complete
+        # once a term from another shard turns up and can be written
+        # straight away. Only shards for prefixes with other characters,
+        # mapped to '_', have to be kept until the end.
+        shards = {}
+        shard_count = 0
+        current = None
+        for term, postings in index.items():
+            name = search_shard(term, prefix_length)
+            if name != current and current in shards and \
+                    re.match('[a-z0-9]*$', current):
+                write_shard(current, shards.pop(current))
+            if name not in shards:
+                shard_count += 1
+            shards.setdefault(name, {})[term] = term_frequencies(postings)
+            current = name
+        for name, terms in sorted(shards.items()):
+            write_shard(name, terms)
+    else:
+        names = {prefix: search_shard(prefix, prefix_length)
+                 for prefix in {term[:prefix_length]
+                                for term in index.postings}}
+        changed_shards = {search_shard(term, prefix_length)
+                          for term in changed_terms}
+        shards = {name: {} for name in names.values()}
+        for term, postings in index.postings.items():
+            name = names[term[:prefix_length]]
+            if name in changed_shards:
+                shards[name][term] = term_frequencies(postings)
+        for name, terms in sorted(shards.items()):
+            write_shard(name, terms)
+        shard_count = len(shards)
+    tables = {number // SEARCH_PAGES_PER_FILE
+              for number in changed_pages or ()}
+    for start in range(0, len(index.pages), SEARCH_PAGES_PER_FILE):
+        outputs.append(os.path.join(search_dir, 'pages-{}.json'.format(
+            start // SEARCH_PAGES_PER_FILE)))
+        if changed_pages is not None and \
+                start // SEARCH_PAGES_PER_FILE not in tables:
+            continue
+        write_json(outputs[-1],
+                   [[link, title, index.lengths[number]]
+                    for number, (link, title) in enumerate(
+                        index.pages[start:start + SEARCH_PAGES_PER_FILE],
+                        start)], writer)
+
+    # Words the index can't hold are left out of queries by the script:
+    config = {'directory': search_dir + '/', 'prefixLength': prefix_length,
+              'pagesPerFile': SEARCH_PAGES_PER_FILE,
+              'ignored': sorted(index.stop_words | index.pruned),
+              'pages': len(index.pages), 'totalLength': index.total_length,
+              'k1': index.k1, 'b': index.b}
+    writer.write(searchpage, templates['search.html'].substitute(
+        site_title=site_title, css=css, root=proj_root, homepage=homepage,
+        searchpage=searchpage, config=json.dumps(config, sort_keys=True),
+        script=templates['search.js'].substitute()))
+
+    log('{} generated with {} search index shards.'.format(
+        searchpage, shard_count))
+    return [searchpage] + sorted(outputs)
+
+
+# A sitemap may list at most this many URLs, so larger sites get an index of
+# several sitemaps:
+SITEMAP_URLS = 50000
+
+
+def feed_files(category):
+    return [category + '/atom.xml', category + '/rss.xml']
+
+
+def generate_feeds(site_title, base_url, category, entries, feed_entries=20,
+                   templates=None, writer=None, dates=None, log=print):
+    """Write Atom and RSS feeds of the newest feed_entries entries of a
+    category's archive, returning their paths. dates is the parse_date cache
+    of the build, if any."""
+    import arrow
+    from email.utils import format_datetime
+    from xml.sax.saxutils import escape
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    entries = entries[:feed_entries]
+    dates = {} if dates is None else dates
+    stamps = [parse_date(date, dates) if date != '' else None
+              for title, link, date in entries]
+    updated = max((stamp for stamp in stamps if stamp is not None),
+                  default=arrow.get(0))
+    atom_entries = []
+    rss_items = []
+    for (title, link, date), stamp in zip(entries, stamps):
+        title, link = escape(title), escape(base_url + link)
+        atom_entries.append(templates['atom_entry.xml'].substitute(
+            title=title, link=link, updated=(stamp or updated).isoformat()))
+        published = ''
+        if stamp is not None:
+            published = templates['rss_pubdate.xml'].substitute(
+                date=format_datetime(stamp.datetime))
+        rss_items.append(templates['rss_item.xml'].substitute(
+            title=title, link=link, published=published))
+
+    atom, rss = feed_files(category)
+    title = escape(site_title + ' - ' + category)
+    link = escape(base_url + category + '/index.html')
+    writer.write(atom, templates['atom.xml'].substitute(
+        title=title, link=link, feed=escape(base_url + atom),
+        updated=updated.isoformat(), author=escape(site_title),
+        entries=''.join(atom_entries)))
+    writer.write(rss, templates['rss.xml'].substitute(
+        title=title, link=link, items=''.join(rss_items)))
+    log('{} and {} generated.'.format(atom, rss))
+    return [atom, rss]
+
+
+def generate_sitemap(base_url, homepage, categories, archives,
+                     entries_per_page=50, templates=None, writer=None,
+                     dates=None, log=print):
+    """Write sitemap.xml, listing the front page, every category archive page
+    and every page, with the date of the newest entry on it as lastmod.
+    Sites of more than SITEMAP_URLS pages get sitemap-1.xml, sitemap-2.xml,
+    ... and an index of them in sitemap.xml. dates is the parse_date cache of
+    the build, if any. Returns the paths written."""
+    from xml.sax.saxutils import escape
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    dates = {} if dates is None else dates
+
+    def lastmod(date):
+        if date == '':
+            return ''
+        return templates['sitemap_lastmod.xml'].substitute(
+            date=parse_date(date, dates).isoformat())
+
+    newest = max((archives[cat][0][2] for cat in categories
+                  if archives[cat][0][2] != ''),
+                 key=lambda date: parse_date(date, dates), default='')
+    urls = [(homepage, lastmod(newest))]
+    for cat in sorted(categories):
+        pages = category_pages(cat, len(archives[cat]), entries_per_page)
+        urls.append((pages[0], lastmod(archives[cat][0][2])))
+        urls.extend((page, '') for page in pages[1:])
+        urls.extend((link, lastmod(date))
+                    for title, link, date in archives[cat])
+    lines = [templates['sitemap_url.xml'].substitute(
+                 loc=escape(base_url + url), lastmod=modified)
+             for url, modified in urls]
+
+    sitemaps = ['sitemap.xml']
+    if len(lines) > SITEMAP_URLS:
+        sitemaps = ['sitemap-{}.xml'.format(number + 1)
+                    for number in range(-(-len(lines) // SITEMAP_URLS))]
+        writer.write('sitemap.xml', templates['sitemap_index.xml'].substitute(
+            sitemaps=''.join(templates['sitemap_index_entry.xml'].substitute(
+                loc=escape(base_url + sitemap)) for sitemap in sitemaps)))
+    for number, sitemap in enumerate(sitemaps):
+        writer.write(sitemap, templates['sitemap.xml'].substitute(
+            urls=''.join(lines[number * SITEMAP_URLS:
+                               (number + 1) * SITEMAP_URLS])))
+    log('sitemap.xml generated with {} URLs.'.format(len(lines)))
+    return sorted(set(['sitemap.xml'] + sitemaps))
+
+
+def write_json(path, value, writer):
+    writer.write(path, json.dumps(value, separators=(',', ':'),
+                                  ensure_ascii=False, sort_keys=True))
 
 
 def generate_static_page(site_title, homepage, searchpage, meta, css, ts_frmt,
-                         proj_root, media_dir="../media"):
-    for cat in meta.categories:
-        category = cat.lower()
-        utils.mkdir(category)
-
-        with open(os.path.join(category, meta.slug) + '.html', 'w') as op_file:
-            print('<html>', file=op_file)
-            print('    <title>{} ({})</title>'.format(
-                  meta.title.title(), category.title()), file=op_file)
-            print('    <body>', file=op_file)
-            print('    <header>', file=op_file)
-            print('    <h3>{} - {}</h3>'.format(
-                  site_title.title(), category.title()), file=op_file)
-            print('        <nav>', file=op_file)
-            print('        <link rel="stylesheet" type="text/css"' +
-                  ' media="screen" href="{}" />'.format(css), file=op_file)
-            print('        <title>{}</title>'.format(meta.title), file=op_file)
-            link_bar = '<a href="{0}{1}">Home</a> | '
-            link_bar += '<a href="index.html">{3}</a> | '
-            link_bar += '<a href="{0}{2}">Search</a>'
-            print(link_bar.format(proj_root, homepage, searchpage,
-                  category.title()), file=op_file)
-            print('        </nav>', file=op_file)
-            print('    </header>', file=op_file)
-            print('    <article>', file=op_file)
-            if meta.header_image != "":
-                print('    <figure>', file=op_file)
-                img_path = os.path.join(media_dir, meta.header_image)
-                print('<img src="{}" />'.format(img_path), file=op_file)
-                print('    </figure>', file=op_file)
-            print('        <h2>{}</h2>'.format(meta.title), file=op_file)
-            print(    meta.content, file=op_file)
-            print('    </article></body>', file=op_file)
-            print('<p></p>', file=op_file)
-            date = \
-                arrow.get(meta.date).format(ts_frmt) if meta.date != '' else ''
-
-            print('        <h5>{}, {}</h5>'.format(meta.authors, date),
-                  file=op_file)
-            if meta.tags not in [[], ['']]:
-                tags = []
-                for tag in meta.tags:
-                    linked_tag = '<a href="{proj_root}{search}#{tag}">{tag}</a>'
-                    tags.append(linked_tag.format(proj_root=proj_root,
-                                                  search=searchpage,
-                                                  tag=tag.strip().lower()))
-                print('    <tiny>Tags: {}</tiny>'.format(", ".join(tags)),
-                      file=op_file)
-                print('<p></p>', file=op_file)
-            print('</html>', file=op_file)
+                         proj_root, media_dir="../media", templates=None,
+                         writer=None, images=None, shadowed=()):
+    """Write one copy of the page per category, returning the paths, except
+    those in shadowed. images maps header images to their derivatives, as
+    media.build_media records them; other header images are linked in
+    media_dir as they are."""
+    templates = templates or default_templates()
+    writer = writer or output.Writer()
+    header_image = ''
+    if meta.header_image != "":
+        header_image = templates['header_image.html'].substitute(
+            **image_attributes(meta.header_image, media_dir, images or {}))
+    tags = ''
+    if meta.tags not in [[], ['']]:
+        tags = templates['tags.html'].substitute(tags=", ".join(
+            templates['tag.html'].substitute(
+                root=proj_root, searchpage=searchpage, tag=tag.strip().lower())
+            for tag in meta.tags))
+    date = get_arrow(meta.date).format(ts_frmt) if meta.date != '' else ''
+
+    outputs = []
+    for category, path in zip(meta.categories,
+                              page_outputs(meta.categories, meta.slug)):
+        category = category.lower()
+        if path in shadowed:
+            continue
+        outputs.append(path)
+        writer.write(path, templates['page.html'].substitute(
+            title=meta.title, title_cased=meta.title.title(),
+            site_title_cased=site_title.title(),
+            category_cased=category.title(), css=css, root=proj_root,
+            homepage=homepage, searchpage=searchpage,
+            header_image=header_image, content=meta.content,
+            authors=meta.authors, date=date, tags=tags))
+    return outputs
+
+
+def page_outputs(categories, slug):
+    """Paths of the copies of a page, one per category."""
+    return [os.path.join(category.lower(), slug) + '.html'
+            for category in categories]
+
+
+def image_attributes(name, media_dir, images):
+    """The src and srcset of a header image, for a page one directory below
+    the site's root."""
+    image = images.get(name)
+    if image is None:
+        return {'src': os.path.join(media_dir, name), 'srcset': ''}
+    srcset = ''
+    if len(image['srcset']) > 1:
+        srcset = ' srcset="{}" sizes="(max-width: {}px) 100vw, {}px"'.format(
+            ', '.join('../{} {}w'.format(path, width)
+                      for path, width in image['srcset']),
+            image['width'], image['width'])
+    if image['width'] is not None:
+        srcset += ' width="{}" height="{}"'.format(image['width'],
+                                                   image['height'])
+    return {'src': '../' + image['src'], 'srcset': srcset}
+
 
 def create_entry(folder, timestamp=None, title=None, filename=None,
                  categories='', name='', tags='', header_image='',
@@ -361,51 +771,134 @@ def create_entry(folder, timestamp=None, title=None, filename=None,
         op.write(content)
     return filepath
 
-def edit(path_to_file):
-    texteditor = utils.get_properties().get('text_editor', None)
+def edit(path_to_file, properties):
+    from subprocess import Popen
+    texteditor = properties.get('text_editor', None)
     if texteditor is None:
         print("No texteditor set in properties file: {}\nRun '{} {}' manually"
               .format(utils.DEFAULT_PROPERTIES_FILE, texteditor, path_to_file))
     else:
         Popen([texteditor, path_to_file])
 
-def new(categories):
+# Every command is passed the properties, read once by main().
+
+def new(properties, categories):
     """Create a new entry"""
-    output_directory = utils.get_properties().get('output_directory', '.')
-    source_directory = utils.get_properties().get('source_directory', None)
-    media_directory = utils.get_properties().get('media_directory', None)
-    author = utils.get_properties().get('default_author', None)
+    source_directory = properties.get('source_directory', None)
+    author = properties.get('default_author', None)
     cats = "_".join([category.lower() for category in categories])
     filename = cats + '_' + datetime.now().strftime("%Y-%m-%d")
     path_to_file = create_entry(source_directory, filename=filename,
                                 categories=categories, name=author)
-    edit(path_to_file)
+    edit(path_to_file, properties)
 
-def make(categories):
+def make(properties, categories, exclude=None, jobs=1, profile=None,
+         low_memory=False, precompress=None):
     """Generate website"""
-    # TODO: pass in category arg so only builds for one or more categories
-    # TODO: Include the ability to selectively publish or exclude certain
-    # categories, i.e. ./scripts/generate_website.py --only=Blog
-    # or ./scripts/generate_website.py --exclude=Work, Personal
-    if categories:
-        raise NotImplementedError(
-            "Generating only selected categories is not implemented yet!")
+    import arrow
     time_now = arrow.now().strftime('%d-%b-%y %H:%M:%S')
     print("{}: Generating pages".format(time_now))
-    properties = utils.get_properties()
-    generate_pages(properties=properties)
-
-def view():
+    if low_memory:
+        properties = dict(properties, low_memory=True)
+    if precompress is not None:
+        properties = dict(properties, precompress=precompress)
+    jobs = jobs or os.cpu_count()
+    profiler = timing.Profiler()
+    generate_pages(properties=properties, jobs=jobs, profiler=profiler,
+                   categories=categories, exclude=exclude)
+    if profile:
+        slowest = properties.get('profile_slowest', 10)
+        print(profiler.table(slowest))
+        profiler.save(profile, slowest, version=__version__, jobs=jobs,
+                      time=arrow.utcnow().isoformat())
+        print('Profile written to {}.'.format(profile))
+
+def inventory(properties, categories, drafts=False):
+    """List the entries, newest first, reading only their meta blocks"""
+    from pyquo import frontmatter
+    directory = properties.get('source_directory', 'markdown')
+    only = normalise_categories(categories)
+    entries = []
+    unfiled = 0
+    for path in discover_sources(directory):
+        md_meta = frontmatter.read_front_matter(path)
+        if not md_meta:
+            unfiled += 1
+            continue
+        meta = page_meta(md_meta)
+        if not selected(meta.categories, only) or (drafts and meta.publish):
+            continue
+        entries.append((meta, path))
+    dates = {}
+    entries.sort(key=lambda entry: parse_date(entry[0].date, dates),
+                 reverse=True)
+    for meta, path in entries:
+        print('{:<10}  {:<5}  {:<20}  {}  ({})'.format(
+            meta.date, 'draft' if meta.publish is not True else '',
+            ', '.join(meta.categories), meta.title, path))
+    print('{} entries, {} of them unpublished.'.format(
+        len(entries), sum(meta.publish is not True for meta, _ in entries)))
+    if unfiled:
+        print('{} sources without a meta block.'.format(unfiled))
+
+def watch(properties, host='localhost', port=8000, jobs=1, poll=False):
+    """Serve the website and rebuild it as sources change"""
+    from pyquo.site import Site
+    from pyquo.watch import watch as watch_site
+    jobs = jobs or os.cpu_count()
+    # One site is kept, so a rebuild only looks at the files which changed
+    # and updates what the last build gathered from every page:
+    site = Site(properties, log=print)
+
+    def build(changed, on_pages_written):
+        site.build(jobs, on_pages_written=on_pages_written, changed=changed,
+                   save=False)
+
+    watch_site(properties, build, host=host, port=port, poll=poll,
+               save=site.save)
+
+def cache(properties, action):
+    """Show or clear the parse cache"""
+    import arrow
+    from pyquo.cache import open_cache
+    cache_file = properties.get('parse_cache_file', '.pyquo_cache.sqlite')
+    if not os.path.exists(cache_file):
+        print('There is no parse cache at {}.'.format(cache_file))
+        return
+    parse_cache = open_cache(cache_file)
+    if action == 'clear':
+        parse_cache.clear()
+        print('Parse cache {} cleared.'.format(cache_file))
+        return
+    stats = parse_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print('Parse cache:   {}'.format(stats['path']))
+    print('Entries:       {}'.format(stats['entries']))
+    print('Size:          {:.1f} MB of {} MB ({:.1f} MB on disk)'.format(
+        stats['size'] / 2 ** 20, properties.get('parse_cache_size', 256),
+        stats['file_size'] / 2 ** 20))
+    print('Hits:          {} of {} lookups ({:.0%})'.format(
+        stats['hits'], lookups, stats['hits'] / lookups if lookups else 0))
+    print('Evicted:       {}'.format(stats['evicted']))
+    if stats['entries']:
+        for label, used in [('Oldest entry', stats['oldest']),
+                            ('Newest entry', stats['newest'])]:
+            print('{:<15}{}'.format(label + ':', arrow.get(used).to(
+                'local').strftime('%d-%b-%y %H:%M:%S')))
+
+def view(properties):
     """Open locally generated html in browser"""
-    browser = utils.get_properties().get('default_browser', None)
-    output_directory = utils.get_properties().get('output_directory', None)
+    from subprocess import Popen
+    browser = properties.get('default_browser', None)
+    output_directory = properties.get('output_directory', None)
     Popen([browser, output_directory + "index.html"])
 
-def properties():
+def properties(properties):
     """View properties"""
+    from pprint import pprint
     # TODO: replace this with get and set
     print("Contents of {}:".format(utils.DEFAULT_PROPERTIES_FILE))
-    pprint(utils.get_properties())
+    pprint(properties)
 
 def collect_args():
     parser = argparse.ArgumentParser(
@@ -422,8 +915,58 @@ def collect_args():
     make_cmd = subparsers.add_parser('make', help=make.__doc__)
     make_cmd.add_argument('categories', nargs='*',
                           help='Selected list of categories to build')
+    make_cmd.add_argument('-x', '--exclude', nargs='+', metavar='CATEGORY',
+                          help='Categories to leave as they were built last '
+                               'time')
+    make_cmd.add_argument('-j', '--jobs', type=int, default=1,
+                          help='Number of worker processes to parse and '
+                               'render pages with (0 for one per CPU)')
+    make_cmd.add_argument('--low-memory', action='store_true',
+                          help='Keep the search index and the words of each '
+                               'page in an sqlite database rather than in '
+                               'memory, for very large sites')
+    make_cmd.add_argument('--precompress', action='store_const', const=True,
+                          help='Also write a gzip (and, with the brotli '
+                               'module, a brotli) copy of every HTML, JSON, '
+                               'CSS and XML file, for the web server to send '
+                               'as it is. Later builds keep the copies up to '
+                               'date until --no-precompress is given')
+    make_cmd.add_argument('--no-precompress', action='store_const',
+                          dest='precompress', const=False,
+                          help='Stop precompressing and remove the copies')
+    make_cmd.add_argument('--profile', nargs='?', metavar='REPORT',
+                          const='.pyquo_profile.json',
+                          help='Print the time spent in each phase of the '
+                               'build and the slowest sources, and save them '
+                               'as JSON to REPORT (default: %(const)s)')
     make_cmd.set_defaults(command=make)
 
+    list_cmd = subparsers.add_parser('list', help=inventory.__doc__)
+    list_cmd.add_argument('categories', nargs='*',
+                          help='Only list entries filed under these '
+                               'categories')
+    list_cmd.add_argument('--drafts', action='store_true',
+                          help='Only list unpublished entries')
+    list_cmd.set_defaults(command=inventory)
+
+    watch_cmd = subparsers.add_parser('watch', aliases=['serve'],
+                                      help=watch.__doc__)
+    watch_cmd.add_argument('--host', default='localhost',
+                           help='Address to serve the website on')
+    watch_cmd.add_argument('-p', '--port', type=int, default=8000,
+                           help='Port to serve the website on')
+    watch_cmd.add_argument('-j', '--jobs', type=int, default=1,
+                           help='Number of worker processes to parse and '
+                                'render pages with (0 for one per CPU)')
+    watch_cmd.add_argument('--poll', action='store_true',
+                           help='Poll for changes instead of using inotify')
+    watch_cmd.set_defaults(command=watch)
+
+    cache_cmd = subparsers.add_parser('cache', help=cache.__doc__)
+    cache_cmd.add_argument('action', choices=['stats', 'clear'],
+                           nargs='?', default='stats')
+    cache_cmd.set_defaults(command=cache)
+
     view_cmd = subparsers.add_parser('view', help=view.__doc__)
     view_cmd.set_defaults(command=view)
 
@@ -434,7 +977,7 @@ def collect_args():
 
 def main():
     command, args = utils.parse_args(collect_args())
-    command(**args)
+    command(utils.get_properties(), **args)
 
 if __name__ == "__main__":
     sys.exit(main())
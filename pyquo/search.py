@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+
+import json
+import math
+import hashlib
+from array import array
+from itertools import groupby
+from collections import Counter
+
+# Common English words which are never worth indexing. Words of two letters
+# or fewer are dropped anyway so are not listed.
+STOP_WORDS = frozenset("""
+    about above after again against all also and any are because been before
+    being below between both but can could did does doing down during each
+    few for from further had has have having her here hers herself him
+    himself his how into its itself just more most myself nor not now off
+    once only other our ours ourselves out over own same she should some such
+    than that the their theirs them themselves then there these they this
+    those through too under until very was were what when where which while
+    who whom why will with would you your yours yourself yourselves
+    """.split())
+
+
+def indexable(word):
+    """Whether a word from a page's text is worth indexing at all. Applied
+    when the page is parsed, so the counts kept for each page stay small."""
+    return len(word) > 2 and not word[0].isdigit() and '_' not in word
+
+
+class SearchIndex(object):
+    """Inverted index of term -> {page number: term frequency}.
+
+    Pages are numbered in the order they are added. Postings are dicts keyed
+    by page number, so adding a page costs one insertion per distinct term
+    regardless of how many pages already use it. Results are ranked with
+    BM25. A page can be replaced once the index is built, which costs only
+    as much as the page's own terms.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, stop_words=STOP_WORDS, max_document_frequency=0.4,
+                 min_pages=10):
+        self.stop_words = frozenset(stop_words)
+        self.max_document_frequency = max_document_frequency
+        self.min_pages = min_pages
+        self.postings = {}
+        self.pages = []
+        self.lengths = []
+        self.total_length = 0
+        # Tags are counted, so replace() can tell when a tag is gone:
+        self.tags = Counter()
+        self.pruned = set()
+        # The postings of pruned terms, for replace() to bring back:
+        self.common = {}
+        self.digests = {}
+        self.page_digests = {}
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, term):
+        return term in self.postings
+
+    def add(self, link, title, words, tags=()):
+        """Index a page given its word counts, already filtered by
+        indexable(), and its tags; tags are always indexed, however common
+        they are."""
+        number = len(self.pages)
+        self.pages.append((link, title))
+        counts = self.counts(words, tags)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[number] = count
+        self.lengths.append(sum(counts.values()))
+        self.total_length += self.lengths[-1]
+        return number
+
+    def counts(self, words, tags):
+        """The terms a page is indexed under, counting its tags in."""
+        counts = Counter(words)
+        for word in self.stop_words:
+            if word in counts:
+                del counts[word]
+        for tag in tags:
+            if tag:
+                counts[tag] += 1
+                self.tags[tag] += 1
+        return counts
+
+    def replace(self, number, link, title, words, tags, old_words, old_tags):
+        """Index page number again, as add() would have, given the words and
+        tags it was indexed with before. Terms the change makes common
+        enough to prune, or no longer, are moved as prune() would have.
+        Returns the terms whose postings or pruning may have changed."""
+        old = Counter(old_words)
+        for word in self.stop_words:
+            if word in old:
+                del old[word]
+        for tag in old_tags:
+            if tag:
+                old[tag] += 1
+                self.tags[tag] -= 1
+                if not self.tags[tag]:
+                    del self.tags[tag]
+        counts = self.counts(words, tags)
+        touched = {term for term in set(old) | set(counts)
+                   if old.get(term) != counts.get(term)}
+        # Only tags are never pruned, so a term tagged or no longer is too:
+        touched.update(tag for tag in set(old_tags) ^ set(tags) if tag)
+        for term in touched:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.common.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+            if term in counts:
+                postings[number] = counts[term]
+            else:
+                del postings[number]
+        for term in touched:
+            self.digests.pop(term, None)
+            postings = self.postings.get(term, self.common.get(term))
+            if not postings:
+                self.postings.pop(term, None)
+                self.common.pop(term, None)
+                self.pruned.discard(term)
+            elif self.is_common(term, len(postings)):
+                if term in self.postings:
+                    self.common[term] = self.postings.pop(term)
+                    self.pruned.add(term)
+            elif term in self.common:
+                self.postings[term] = self.common.pop(term)
+                self.pruned.discard(term)
+        self.pages[number] = (link, title)
+        self.total_length += sum(counts.values()) - self.lengths[number]
+        self.lengths[number] = sum(counts.values())
+        self.page_digests.pop(number, None)
+        return touched
+
+    def is_common(self, term, document_frequency):
+        """Whether prune() drops a term found on document_frequency pages."""
+        return (len(self.pages) >= self.min_pages and
+                document_frequency >
+                len(self.pages) * self.max_document_frequency and
+                term not in self.tags)
+
+    def prune(self):
+        """Drop terms, other than tags, found on more than
+        max_document_frequency of the pages. Small sites are left alone as
+        every word looks common there. Returns the dropped terms."""
+        common = sorted(term for term, postings in self.postings.items()
+                        if self.is_common(term, len(postings)))
+        for term in common:
+            self.common[term] = self.postings.pop(term)
+            self.digests.pop(term, None)
+        self.pruned = set(common)
+        return common
+
+    def unindexed(self, term):
+        """Whether term could never be in the index: a word indexable()
+        rejects, a stop word or one pruned as too common. A query is
+        matched without such words, rather than matching nothing."""
+        return (not indexable(term) or term in self.stop_words or
+                term in self.pruned)
+
+    def document_frequency(self, term):
+        return len(self.postings.get(term, ()))
+
+    def items(self):
+        """(term, postings) for every term, in term order."""
+        return sorted(self.postings.items())
+
+    def document_frequencies(self):
+        """(term, number of pages using it) for every term, in term order."""
+        return [(term, len(postings)) for term, postings in self.items()]
+
+    def fingerprint(self):
+        """Hash of the pages, their lengths and the postings: the sum of a
+        hash of each page and each term, which are kept so that after
+        replace() only what it changed is hashed again."""
+        for number, (link, title) in enumerate(self.pages):
+            if number not in self.page_digests:
+                self.page_digests[number] = digest(
+                    [number, link, title, self.lengths[number]])
+        for term, postings in self.postings.items():
+            if term not in self.digests:
+                self.digests[term] = digest([term, sorted(postings.items())])
+        total = sum(self.page_digests.values()) + sum(self.digests.values())
+        return '{:040x}'.format(total % 2 ** 160)
+
+    def scores(self, term):
+        """BM25 score of term for each page it appears on."""
+        return self.score(self.postings.get(term, {}))
+
+    def score(self, postings):
+        """BM25 score of a term for each page of its postings."""
+        if not postings:
+            return {}
+        count = len(self.pages)
+        average_length = (self.total_length / count) or 1
+        idf = math.log(1 + (count - len(postings) + 0.5) /
+                       (len(postings) + 0.5))
+        scores = {}
+        for number, frequency in postings.items():
+            norm = self.k1 * (1 - self.b + self.b *
+                              self.lengths[number] / average_length)
+            scores[number] = idf * frequency * (self.k1 + 1) / (
+                frequency + norm)
+        return scores
+
+    def ranked(self, term):
+        """Page numbers containing term, best match first."""
+        scores = self.scores(term)
+        return sorted(scores, key=lambda number: (-scores[number], number))
+
+    def search(self, query):
+        """Pages containing every word of query which could be indexed,
+        best match first."""
+        totals = None
+        for term in query.lower().split():
+            scores = self.scores(term)
+            if not scores and self.unindexed(term):
+                continue
+            if totals is None:
+                totals = scores
+            else:
+                totals = {number: totals[number] + score
+                          for number, score in scores.items()
+                          if number in totals}
+        totals = totals or {}
+        return [self.pages[number] for number in
+                sorted(totals, key=lambda number: (-totals[number], number))]
+
+
+def digest(value):
+    return int.from_bytes(hashlib.sha1(json.dumps(value).encode('utf-8'))
+                          .digest(), 'big')
+
+
+class Stored(object):
+    """Stands in for the word counts of a page kept by a SpilledIndex."""
+
+    __slots__ = ['source']
+
+    def __init__(self, source):
+        self.source = source
+
+
+class SpilledIndex(SearchIndex):
+    """A SearchIndex kept in an sqlite database rather than in memory.
+
+    The word counts of each source are saved with store() when it is parsed
+    and kept between builds, so unchanged pages are indexed by passing
+    Stored(source) to add() and their words never have to be loaded. Once
+    every page has been added their postings are copied into a temporary
+    table in term order, which sqlite keeps on disk once it outgrows its
+    cache, and read back a term at a time.
+    """
+
+    def __init__(self, path, stop_words=STOP_WORDS, max_document_frequency=0.4,
+                 min_pages=10):
+        import sqlite3
+        super().__init__(stop_words, max_document_frequency, min_pages)
+        self.postings = None
+        self.lengths = array('l')
+        self.finished = False
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            PRAGMA synchronous = OFF;
+            PRAGMA temp_store = FILE;
+            CREATE TABLE IF NOT EXISTS words (
+                source TEXT, term TEXT, frequency INTEGER);
+            CREATE INDEX IF NOT EXISTS words_source ON words (source);
+            CREATE TEMP TABLE stop_words (term TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TEMP TABLE stored (page INTEGER, source TEXT);
+            CREATE TEMP TABLE added (term TEXT, page INTEGER, frequency INTEGER);
+            CREATE TEMP TABLE postings (
+                term TEXT, page INTEGER, frequency INTEGER,
+                PRIMARY KEY (term, page)) WITHOUT ROWID;
+            """)
+        self.connection.executemany('INSERT INTO stop_words VALUES (?)',
+                                    ((word,) for word in self.stop_words))
+
+    def __contains__(self, term):
+        self.finish()
+        return self.connection.execute(
+            'SELECT 1 FROM postings WHERE term = ? LIMIT 1',
+            (term,)).fetchone() is not None
+
+    def store(self, source, words):
+        """Keep the word counts of source, replacing any kept before."""
+        self.connection.execute('DELETE FROM words WHERE source = ?',
+                                (source,))
+        self.connection.executemany(
+            'INSERT INTO words VALUES (?, ?, ?)',
+            ((source, term, count) for term, count in words.items()))
+
+    def keep_only(self, sources):
+        """Forget the word counts of every source not in sources."""
+        self.connection.execute('CREATE TEMP TABLE sources (source TEXT)')
+        self.connection.executemany('INSERT INTO sources VALUES (?)',
+                                    ((source,) for source in sources))
+        self.connection.execute('DELETE FROM words WHERE source NOT IN '
+                                '(SELECT source FROM sources)')
+        self.connection.execute('DROP TABLE sources')
+
+    def add(self, link, title, words, tags=()):
+        """Index a page given its word counts, or Stored(source) for counts
+        saved by store(), and its tags."""
+        number = len(self.pages)
+        self.pages.append((link, title))
+        if isinstance(words, Stored):
+            self.connection.execute('INSERT INTO stored VALUES (?, ?)',
+                                    (number, words.source))
+        else:
+            self.connection.executemany(
+                'INSERT INTO added VALUES (?, ?, ?)',
+                ((term, number, count) for term, count in words.items()
+                 if term not in self.stop_words))
+        tags = [tag for tag in tags if tag]
+        self.connection.executemany('INSERT INTO added VALUES (?, ?, 1)',
+                                    ((tag, number) for tag in tags))
+        self.tags.update(tags)
+        return number
+
+    def finish(self):
+        """Gather the postings of every page added, in term order, and
+        measure the pages. Called before the index is first read."""
+        if self.finished:
+            return
+        self.finished = True
+        self.connection.executescript("""
+            INSERT INTO added
+                SELECT words.term, stored.page, words.frequency
+                FROM stored JOIN words ON words.source = stored.source
+                WHERE words.term NOT IN (SELECT term FROM stop_words);
+            INSERT INTO postings
+                SELECT term, page, SUM(frequency) FROM added
+                GROUP BY term, page ORDER BY term, page;
+            DROP TABLE added;
+            DROP TABLE stored;
+            """)
+        self.lengths = array('l', [0]) * len(self.pages)
+        for number, length in self.connection.execute(
+                'SELECT page, SUM(frequency) FROM postings GROUP BY page'):
+            self.lengths[number] = length
+        self.total_length = sum(self.lengths)
+
+    def prune(self):
+        self.finish()
+        if len(self.pages) < self.min_pages:
+            return []
+        threshold = len(self.pages) * self.max_document_frequency
+        common = sorted(term for term, in self.connection.execute(
+            'SELECT term FROM postings GROUP BY term HAVING COUNT(*) > ?',
+            (threshold,)) if term not in self.tags)
+        self.connection.executemany('DELETE FROM postings WHERE term = ?',
+                                    ((term,) for term in common))
+        self.pruned = set(common)
+        return common
+
+    def document_frequency(self, term):
+        self.finish()
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM postings WHERE term = ?',
+            (term,)).fetchone()[0]
+
+    def items(self):
+        self.finish()
+        rows = self.connection.execute(
+            'SELECT term, page, frequency FROM postings ORDER BY term, page')
+        for term, group in groupby(rows, key=lambda row: row[0]):
+            yield term, {page: frequency for _, page, frequency in group}
+
+    def document_frequencies(self):
+        self.finish()
+        return self.connection.execute(
+            'SELECT term, COUNT(*) FROM postings GROUP BY term ORDER BY term')
+
+    def fingerprint(self):
+        self.finish()
+        digest = hashlib.sha1(json.dumps(
+            [self.pages, list(self.lengths)]).encode('utf-8'))
+        rows = self.connection.execute(
+            'SELECT term, page, frequency FROM postings ORDER BY term, page')
+        chunk = rows.fetchmany(10000)
+        while chunk:
+            digest.update(repr(chunk).encode('utf-8'))
+            chunk = rows.fetchmany(10000)
+        return digest.hexdigest()
+
+    def scores(self, term):
+        self.finish()
+        return self.score(dict(self.connection.execute(
+            'SELECT page, frequency FROM postings WHERE term = ?', (term,))))
+
+    def close(self):
+        """Save the word counts and drop the postings."""
+        self.connection.commit()
+        self.connection.close()
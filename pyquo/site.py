@@ -0,0 +1,719 @@
+#!/usr/bin/python3
+
+import os
+import threading
+from types import SimpleNamespace
+from itertools import chain
+from pyquo import manifest
+from pyquo import output
+from pyquo import search
+from pyquo import timing
+from pyquo import __version__
+from pyquo.templates import load_templates
+from pyquo.pyquo import (
+    normalise_categories, selected, discover_sources, page_meta, dump_meta,
+    load_meta, page_outputs, build_pages, extract_site_wide_metadata,
+    page_tags, chronology_key, chronology_entries, order_archives,
+    search_link, search_terms,
+    category_pages, feed_files, generate_front_and_category_pages,
+    generate_feeds, generate_sitemap, generate_search_page)
+
+
+class Site(object):
+    """A site and how to build it, incrementally, for pyquo make and watch or
+    from Python, e.g. in a long running service building many sites.
+
+    properties are the settings pyquo make reads from the properties file.
+    The sources, media, templates and the files kept between builds are
+    looked for under directory, the current directory unless given, so that
+    sites can be built side by side in threads without changing directory.
+    Outputs are written to backend: an output.FileOutput for the
+    output_directory unless it is an output.MemoryOutput, to serve them
+    from memory, or an output.ArchiveOutput. Only a FileOutput build reads
+    and saves the manifest file; the manifest is kept in manifest between
+    builds anyway, so building again only rewrites what changed.
+
+    Progress is reported by calling log with each message, and not at all
+    unless it is given.
+    """
+
+    def __init__(self, properties, directory=None, backend=None, log=None):
+        self.properties = properties = dict(properties)
+        self.directory = directory
+        self.log = log or (lambda message: None)
+        self.manifest = None
+        # What the last build gathered from every page, for a build told
+        # which files changed to update rather than gather again:
+        self.aggregate = None
+        # A site's manifest and outputs can only take one build at a time:
+        self.lock = threading.Lock()
+
+        self.proj_root = properties.get('root', '/')
+        self.homepage = properties.get('homepage', 'index.html')
+        self.searchpage = properties.get('searchpage', 'search.html')
+        self.site_title = properties.get('site_title', 'PyQuo')
+        self.ts_frmt = properties.get('timestamp_format',
+                                      'dddd DD MMMM, YYYY')
+        self.source_directory = properties.get('source_directory',
+                                               'markdown')
+        self.media_directory = properties.get('media_directory', 'media')
+        # Header images are resized to each of these widths and written
+        # under content-hashed names, which can be cached for ever:
+        self.derive_media = properties.get('media_derivatives', True)
+        self.derived_directory = properties.get('derived_media_directory',
+                                                'assets')
+        self.media_widths = properties.get('media_widths', [480, 960, 1600])
+        self.media_quality = properties.get('media_quality', 80)
+        self.css = properties.get('css')
+        # Absolute links in sitemap.xml and the feeds start with site_url,
+        # e.g. https://example.com. Both need absolute links, so neither is
+        # written without it:
+        self.site_url = properties.get('site_url', '')
+        self.write_sitemap = properties.get('sitemap', True)
+        self.write_feeds = properties.get('feeds', True)
+        self.missing_site_url = not self.site_url and (self.write_sitemap or
+                                                       self.write_feeds)
+        if not self.site_url:
+            self.write_sitemap = self.write_feeds = False
+        self.feed_entries = properties.get('feed_entries', 20)
+        # Write a compressed copy of every text output for the web server.
+        # Unless set either way, builds carry on doing what the last did:
+        self.precompress = properties.get('precompress')
+        self.entries_to_show = properties.get('entries_to_show', 10)
+        self.entries_per_page = properties.get('entries_per_page', 50)
+        # Text for the search index is extracted with a streaming parser
+        # unless BeautifulSoup is asked for, which is around four times
+        # slower:
+        self.parser = None
+        if properties.get('text_extraction', 'stream') == 'beautifulsoup':
+            self.parser = properties.get('beautiful_soup_parser', 'lxml')
+        self.search_dir = properties.get('search_directory', 'search')
+        self.search_prefix_length = properties.get('search_prefix_length', 2)
+        # Keep the word counts of each page and the search index in an
+        # sqlite database instead of memory and the manifest, for very large
+        # sites:
+        self.low_memory = properties.get('low_memory', False)
+        self.spill_file = self.local(properties.get(
+            'search_spill_file', '.pyquo_index.sqlite'))
+        self.max_document_frequency = properties.get(
+            'search_max_document_frequency', 0.4)
+        self.stop_words = search.STOP_WORDS.union(
+            properties.get('search_stop_words', []))
+        # Converted sources are cached by content, so a page whose outputs
+        # have to be rewritten (say after a template change) isn't converted
+        # again:
+        self.cache_file = None
+        if properties.get('parse_cache', True):
+            self.cache_file = self.local(properties.get(
+                'parse_cache_file', '.pyquo_cache.sqlite'))
+        self.cache_size = properties.get('parse_cache_size', 256)
+        self.template_directory = properties.get('template_directory')
+
+        if backend is None:
+            backend = output.FileOutput(
+                self.local(properties.get('output_directory') or '.'))
+        self.backend = backend
+        self.manifest_file = None
+        if backend.on_disk:
+            self.manifest_file = self.local(properties.get(
+                'manifest_file', '.pyquo_manifest.json'))
+
+    def local(self, path):
+        """path, relative to the site's directory."""
+        if self.directory is None:
+            return path
+        return os.path.join(self.directory, path)
+
+    def output_location(self):
+        """Where outputs are written, relative to the site's directory, or
+        None if they aren't written to disk."""
+        if not self.backend.on_disk:
+            return None
+        return os.path.relpath(self.backend.directory,
+                               self.directory or '.')
+
+    def build(self, jobs=1, categories=None, exclude=None, profiler=None,
+              on_pages_written=None, changed=None, save=True):
+        """Build the site, returning the backend.
+
+        Given categories, or categories to exclude, sources the previous
+        build filed only under other categories are taken from the manifest
+        as they were, without being looked at, and only the category pages
+        whose entries changed are written again. A new source in another
+        category is left for a build of its category.
+
+        Given changed, the paths of the files which changed since this
+        Site's last build, e.g. as a watcher reports them, only those
+        sources are looked at, and their pages are merged into what the
+        last build gathered from every page rather than gathering it again.
+        Outputs deleted or edited since are then only noticed by a build
+        without changed. Pass save=False to leave the manifest for save()
+        to write, when building again soon.
+
+        on_pages_written is called once the pages a reader is likely to be
+        looking at are up to date, before the search index is rewritten.
+        Pass a timing.Profiler to have the time spent in each phase
+        recorded.
+        """
+        from pyquo.cache import close_cache
+        with self.lock:
+            # A build which fails part way leaves nothing to update:
+            aggregate, self.aggregate = self.aggregate, None
+            try:
+                state = self.discover(profiler or timing.Profiler())
+                self.media(state, jobs)
+                self.find_sources(state, categories, exclude, changed,
+                                  aggregate)
+                self.parse(state, jobs)
+                self.index(state, aggregate)
+                self.emit(state, on_pages_written)
+                self.cleanup(state, jobs, save)
+                self.manifest = state.new_manifest
+                self.aggregate = state.aggregate
+            finally:
+                # Each build reopens the parse cache, rather than every site
+                # of a long running process holding a connection to its own:
+                if self.cache_file:
+                    close_cache(self.cache_file)
+        return self.backend
+
+    def save(self):
+        """Save the manifest of the last build made with save=False."""
+        with self.lock:
+            if self.manifest is not None and self.manifest_file is not None:
+                manifest.save_manifest(self.manifest, self.manifest_file)
+
+    def discover(self, profiler):
+        """Start a build: load the templates and the previous manifest, and
+        return the build's state."""
+        from pyquo import media
+        state = SimpleNamespace(profiler=profiler,
+                                writer=output.Writer(self.backend))
+        state.templates = load_templates(self.template_directory and
+                                         self.local(self.template_directory))
+
+        # Anything which changes the rendered output invalidates every page:
+        output_properties = manifest.fingerprint(
+            [__version__, self.proj_root, self.homepage, self.searchpage,
+             self.site_title, self.ts_frmt, self.css, self.entries_to_show,
+             self.entries_per_page, self.parser, self.search_dir,
+             self.search_prefix_length, self.low_memory, self.derive_media,
+             self.derived_directory, self.media_widths, self.media_quality,
+             media.pillow() is not None, self.site_url, self.write_sitemap,
+             self.write_feeds, self.feed_entries,
+             sorted((name, template.template)
+                    for name, template in state.templates.items())])
+        with profiler.phase('discover'):
+            old_manifest = self.manifest
+            if old_manifest is None:
+                old_manifest = manifest.load_manifest(self.manifest_file)
+            state.old_manifest = old_manifest
+            state.same_properties = (old_manifest.get('properties') ==
+                                     output_properties)
+            if state.same_properties:
+                state.previous = old_manifest['sources']
+                state.previous_site = old_manifest['site']
+                state.previous_media = old_manifest['media']
+            else:
+                state.previous = {}
+                state.previous_site = {}
+                state.previous_media = {}
+            if self.low_memory and not os.path.exists(self.spill_file):
+                state.previous = {}
+            state.new_manifest = {'version': manifest.MANIFEST_VERSION,
+                                  'properties': output_properties,
+                                  'sources': {}, 'site': {}, 'media': {},
+                                  'output': self.output_location()}
+        return state
+
+    def media(self, state, jobs=1):
+        """Write the derivatives, or copies, of the images which changed."""
+        from pyquo import media
+        writer = state.writer
+        with state.profiler.phase('media', writer):
+            if self.derive_media:
+                entries, state.changed_images, stats = media.build_media(
+                    self.local(self.media_directory), self.derived_directory,
+                    state.previous_media, self.media_widths,
+                    self.media_quality, jobs, writer, self.log)
+            else:
+                entries, state.changed_images, stats = media.copy_media(
+                    self.local(self.media_directory), state.previous_media,
+                    writer)
+            state.new_manifest['media'] = entries
+            writer.stats.update(stats)
+            state.images = {name: entry['meta']
+                            for name, entry in entries.items()}
+
+    def changed_sources(self, changed, previous, changed_images):
+        """The sources among the changed paths, as the manifest names them,
+        with those showing a changed image, or None if there is a new one,
+        which needs the sources walked to be placed in order."""
+        root = self.local(self.source_directory)
+        paths = set()
+        for path in changed:
+            relative = os.path.relpath(path, root)
+            name = os.path.basename(relative)
+            if relative.split(os.sep)[0] == os.pardir or \
+                    name.startswith('.') or name.endswith('~'):
+                continue
+            path = os.path.join(root, relative)
+            if self.directory is not None:
+                path = os.path.relpath(path, self.directory)
+            if path in previous:
+                paths.add(path)
+            elif os.path.isfile(self.local(path)):
+                return None
+        paths.update(path for path, entry in previous.items()
+                     if entry['meta'] is not None and
+                     entry['meta']['header_image'] in changed_images)
+        return sorted(paths)
+
+    def find_sources(self, state, categories=None, exclude=None,
+                     changed=None, aggregate=None):
+        """Find the sources which changed since the last build, and those
+        whose pages have to be written again."""
+        from pyquo import frontmatter
+        previous = state.previous
+        new_manifest = state.new_manifest
+        with state.profiler.phase('discover', calls=0):
+            only = state.only = normalise_categories(categories)
+            exclude = state.exclude = normalise_categories(exclude)
+            to_build = []
+            drafts = state.drafts = set()
+            counts = {'changed': 0, 'skipped': 0}
+            paths = None
+            if (changed is not None and aggregate is not None and
+                    state.same_properties and only is None and
+                    exclude is None):
+                paths = self.changed_sources(changed, previous,
+                                             state.changed_images)
+            state.incremental = paths is not None
+            if paths is None:
+                pages = {}
+                sources = {}
+                paths = discover_sources(self.local(self.source_directory))
+                if self.directory is not None:
+                    paths = (os.path.relpath(path, self.directory)
+                             for path in paths)
+            else:
+                # Only the changed sources are looked at, and the rest are
+                # as the last build left them:
+                pages = dict(aggregate.outputs)
+                sources = dict(previous)
+                for path in paths:
+                    if not os.path.isfile(self.local(path)):
+                        del sources[path]
+                        pages.pop(path, None)
+                paths = [path for path in paths if path in sources]
+
+            def look_at(path):
+                old_entry = previous.get(path)
+                # Pages showing an image whose derivatives changed are
+                # written again, whichever category they are in:
+                restyled = (old_entry is not None and
+                            old_entry['meta'] is not None and
+                            old_entry['meta']['header_image'] in
+                            state.changed_images)
+                if (old_entry is not None and
+                        old_entry['meta'] is not None and not restyled and
+                        not selected(old_entry['meta']['categories'], only,
+                                     exclude)):
+                    entry, changed = old_entry, False
+                    counts['skipped'] += 1
+                else:
+                    entry, changed = manifest.check_source(
+                        self.local(path), old_entry, self.backend.exists)
+                    changed = changed or restyled
+                pages.pop(path, None)
+                if not changed and entry['meta'] is not None and \
+                        entry['meta']['publish'] is True:
+                    pages[path] = page_outputs(entry['meta']['categories'],
+                                               entry['meta']['slug'])
+                if changed:
+                    # Only the meta block is read at first, so that sources
+                    # without one and drafts are never converted:
+                    md_meta = frontmatter.read_front_matter(self.local(path))
+                    meta = page_meta(md_meta) if md_meta else None
+                    if (meta is not None and
+                            (old_entry is None or
+                             old_entry['meta'] is None) and
+                            not selected(meta.categories, only, exclude)):
+                        # A new page in another category waits for a build
+                        # of its category:
+                        counts['skipped'] += 1
+                        return None
+                    counts['changed'] += 1
+                    if meta is None:
+                        entry['meta'], entry['outputs'] = None, []
+                    elif meta.publish is not True:
+                        meta.index = {}
+                        entry['meta'], entry['outputs'] = dump_meta(meta), []
+                        drafts.add(path)
+                    else:
+                        to_build.append(path)
+                        pages[path] = page_outputs(meta.categories, meta.slug)
+                return entry
+
+            for path in paths:
+                entry = look_at(path)
+                if entry is not None:
+                    sources[path] = entry
+            new_manifest['sources'] = sources
+            sources = state.sources = list(sources)
+            entries = state.entries = list(new_manifest['sources'].values())
+            changed_sources = counts['changed']
+            skipped = counts['skipped']
+            # In the order the sources are found, which decides the pages
+            # shadowed below:
+            pages = state.pages = {path: pages[path] for path in sources
+                                   if path in pages}
+
+            # Pages with the same title in the same category are written to
+            # the same file. The one found last is kept, however many jobs
+            # build them, and a page whose files change hands is written
+            # again:
+            owners = {}
+            for path, outputs in pages.items():
+                for page in outputs:
+                    if page in owners:
+                        self.log('Warning: {} and {} are both written to {}; '
+                                 'the page from {} is kept.'.format(
+                                     owners[page], path, page, path))
+                    owners[page] = path
+            state.shadowed = {
+                path: [page for page in outputs if owners[page] != path]
+                for path, outputs in pages.items()}
+            building = set(to_build)
+            for number, (path, entry) in enumerate(zip(sources, entries)):
+                if path in pages and path not in building and \
+                        entry['outputs'] != [
+                            page for page in pages[path]
+                            if page not in state.shadowed[path]]:
+                    # The entry may be the previous manifest's own:
+                    entries[number] = new_manifest['sources'][path] = \
+                        dict(entry)
+                    building.add(path)
+                    changed_sources += 1
+            state.to_build = [path for path in sources if path in building]
+            state.changed_sources = changed_sources
+            state.skipped = skipped
+
+    def parse(self, state, jobs=1):
+        """Start parsing and rendering the sources to build. Each page is
+        written as soon as it is rendered and only its metadata comes back,
+        for index() to merge as it arrives."""
+        page_args = (self.site_title, self.homepage, self.searchpage,
+                     self.css, self.ts_frmt, self.proj_root, state.templates,
+                     state.images)
+        state.results = build_pages(
+            [self.local(path) for path in state.to_build], self.parser,
+            page_args, jobs, self.cache_file, self.backend,
+            [state.shadowed[path] for path in state.to_build])
+
+    def index(self, state, aggregate=None):
+        """Gather the metadata of every page, and aggregate it once for the
+        whole site. After a build told which files changed, the aggregate
+        of the last build is updated instead, as long as the same pages are
+        published in the same order."""
+        profiler = state.profiler
+        writer = state.writer
+        rebuilt = set(state.to_build)
+        index = None
+        if self.low_memory:
+            index = search.SpilledIndex(self.spill_file, self.stop_words,
+                                        self.max_document_frequency)
+
+        with profiler.phase('index', calls=len(state.sources)):
+            published = []
+            found = []
+            generated = 0
+            for path, entry in zip(state.sources, state.entries):
+                if path in rebuilt:
+                    start = timing.clock()
+                    entry['meta'], entry['outputs'], stats, files = \
+                        next(state.results)
+                    for name, data in files.items():
+                        writer.write(name, data)
+                    profiler.exclude(start)
+                    writer.stats.update(stats)
+                    profiler.add_page(path, stats)
+                    if entry['outputs']:
+                        generated += 1
+                if self.low_memory and \
+                        (path in rebuilt or path in state.drafts) and \
+                        entry['meta'] is not None:
+                    index.store(path, entry['meta']['index'])
+                    entry['meta']['index'] = None
+                if entry['meta'] is None:
+                    continue
+                found.extend(entry['meta']['categories'])
+                if entry['meta']['publish'] is True:
+                    published.append(path)
+            self.log('{} pages generated ({} unchanged) with the following '
+                     'categories: {}.'.format(
+                         generated, len(state.sources) - state.changed_sources,
+                         ', '.join(sorted(set(found)))))
+            if state.skipped:
+                self.log('{} sources in other categories left as they were.'
+                         .format(state.skipped))
+            if state.drafts:
+                self.log('{} unpublished sources skipped.'.format(
+                    len(state.drafts)))
+            for category in sorted((state.only or set()) |
+                                   (state.exclude or set())):
+                if category not in found:
+                    self.log('Warning: no page is filed under {}.'.format(
+                        category))
+            if self.cache_file and state.to_build:
+                self.log('{} of {} sources converted, the rest found in the '
+                         'parse cache.'.format(writer.stats['cache_misses'],
+                                               len(state.to_build)))
+
+            if state.incremental and aggregate.published == published:
+                self.merge(state, aggregate)
+                return
+            all_pages = []
+            for path in published:
+                meta = load_meta(state.new_manifest['sources'][path]['meta'])
+                if self.low_memory:
+                    meta.index = search.Stored(path)
+                all_pages.append(meta)
+            # Dates are parsed once here and reused by the feeds and sitemap:
+            state.dates = {}
+            chronology = {}
+            (state.all_cats, state.tags, state.archives, state.index,
+             state.word_cloud) = extract_site_wide_metadata(
+                all_pages, max_document_frequency=self.max_document_frequency,
+                stop_words=self.stop_words, index=index, dates=state.dates,
+                chronology=chronology, log=self.log)
+            state.changed_categories = None
+            state.changed_terms = state.changed_pages = None
+            state.aggregate = None
+            if not self.low_memory:
+                state.aggregate = SimpleNamespace(
+                    published=published,
+                    numbers={path: number
+                             for number, path in enumerate(published)},
+                    pages=all_pages, outputs=state.pages,
+                    chronology=chronology, dates=state.dates,
+                    categories=state.all_cats, tags=state.tags,
+                    archives=state.archives, index=state.index,
+                    word_cloud=state.word_cloud)
+
+    def merge(self, state, aggregate):
+        """Update the last build's aggregate with the pages parsed again,
+        noting the categories, search terms and search pages they change so
+        that only their outputs are written again."""
+        pages = aggregate.pages
+        tags = aggregate.tags
+        chronology = aggregate.chronology
+        dates = aggregate.dates
+        index = aggregate.index
+        changed_categories = set()
+        changed_terms = set()
+        changed_pages = set()
+        for path in state.to_build:
+            number = aggregate.numbers[path]
+            old = pages[number]
+            page = pages[number] = load_meta(
+                state.new_manifest['sources'][path]['meta'])
+            for tag in page_tags(old):
+                tags[tag] -= 1
+                if not tags[tag]:
+                    del tags[tag]
+            for tag in page_tags(page):
+                tags[tag] = tags.get(tag, 0) + 1
+            old_key = chronology_key(old, number, dates)
+            old_entries = chronology.pop(old_key)
+            key = chronology_key(page, number, dates)
+            entries = chronology[key] = chronology_entries(page)
+            if key != old_key or entries != old_entries:
+                changed_categories.update(old_entries, entries)
+            changed_terms |= index.replace(
+                number, search_link(page), page.title, *search_terms(page),
+                *search_terms(old))
+            changed_pages.add(number)
+        if changed_categories:
+            aggregate.categories = []
+            for page in pages:
+                for category in page.categories:
+                    if category.lower() not in aggregate.categories:
+                        aggregate.categories.append(category.lower())
+            aggregate.archives = order_archives(chronology,
+                                                aggregate.categories)
+        if changed_terms:
+            aggregate.word_cloud = sorted(index.document_frequencies(),
+                                          key=lambda x: x[1], reverse=True)
+        aggregate.outputs = state.pages
+        state.dates = dates
+        state.all_cats = aggregate.categories
+        state.tags = tags
+        state.archives = aggregate.archives
+        state.index = index
+        state.word_cloud = aggregate.word_cloud
+        state.changed_categories = changed_categories
+        state.changed_terms = changed_terms
+        state.changed_pages = changed_pages
+        state.aggregate = aggregate
+
+    def emit(self, state, on_pages_written=None):
+        """Write the site-wide pages: the front page, the category archives
+        and feeds, the sitemap and then the search index."""
+        writer = state.writer
+        templates = state.templates
+        archives = state.archives
+        all_cats = state.all_cats
+        previous_site = state.previous_site
+        site = state.new_manifest['site']
+        if self.missing_site_url:
+            self.log('Warning: site_url is not set, so sitemap.xml and the '
+                     'feeds, which need absolute links, are not written.')
+        # The front page lists the newest entries of each category and a
+        # category's archive only its own entries, so each is written again
+        # only when those change:
+        with state.profiler.phase('render', writer):
+            front_inputs = manifest.fingerprint(
+                [(cat, archives[cat][:self.entries_to_show],
+                  len(archives[cat]) > self.entries_to_show)
+                 for cat in sorted(all_cats)])
+            previous_categories = previous_site.get('categories', {})
+            category_inputs = {}
+            for cat in all_cats:
+                if (state.changed_categories is not None and
+                        cat not in state.changed_categories and
+                        cat in previous_categories):
+                    # Its entries are as the last build left them:
+                    category_inputs[cat] = previous_categories[cat]
+                else:
+                    category_inputs[cat] = manifest.fingerprint(archives[cat])
+            base_url = self.site_url.rstrip('/') + self.proj_root
+            front_outputs = [self.homepage]
+            stale = []
+            for cat in all_cats:
+                pages = category_pages(cat, len(archives[cat]),
+                                       self.entries_per_page)
+                if self.write_feeds:
+                    pages += feed_files(cat)
+                front_outputs.extend(pages)
+                if (category_inputs[cat] != previous_categories.get(cat) or
+                        not all(self.backend.exists(page) for page in pages)):
+                    stale.append(cat)
+            front_page = (front_inputs != previous_site.get('front') or
+                          not self.backend.exists(self.homepage))
+            if front_page or stale:
+                generate_front_and_category_pages(
+                    self.site_title, self.homepage, self.searchpage, all_cats,
+                    state.tags, archives, state.word_cloud, self.proj_root,
+                    self.css, self.ts_frmt, self.entries_to_show,
+                    self.entries_per_page, templates, writer,
+                    front_page=front_page, only=stale, log=self.log)
+            if self.write_feeds:
+                for cat in stale:
+                    generate_feeds(self.site_title, base_url, cat,
+                                   archives[cat], self.feed_entries,
+                                   templates, writer, dates=state.dates,
+                                   log=self.log)
+            site['front'] = front_inputs
+            site['categories'] = category_inputs
+
+            # The sitemap lists every page, but they are all in the archives:
+            if self.write_sitemap:
+                sitemap_inputs = manifest.fingerprint(
+                    [base_url, sorted(category_inputs.items())])
+                sitemap_outputs = previous_site.get('sitemap_outputs', [])
+                if (sitemap_inputs != previous_site.get('sitemap') or
+                        not sitemap_outputs or
+                        not all(self.backend.exists(path)
+                                for path in sitemap_outputs)):
+                    sitemap_outputs = generate_sitemap(
+                        base_url, self.homepage, all_cats, archives,
+                        self.entries_per_page, templates, writer,
+                        dates=state.dates, log=self.log)
+                site['sitemap'] = sitemap_inputs
+                site['sitemap_outputs'] = sitemap_outputs
+                front_outputs.extend(sitemap_outputs)
+        if on_pages_written is not None:
+            on_pages_written()
+
+        index = state.index
+        with state.profiler.phase('render', writer):
+            search_inputs = index.fingerprint()
+            search_outputs = previous_site.get('search_outputs', [])
+            complete = search_outputs and all(self.backend.exists(path)
+                                              for path in search_outputs)
+            if search_inputs != previous_site.get('search') or not complete:
+                # After an edit, only the shards and page tables it changed
+                # are written, as long as the rest are where they were left:
+                incremental = state.changed_terms is not None and complete
+                search_outputs = generate_search_page(
+                    self.site_title, self.homepage, self.searchpage, index,
+                    self.css, self.proj_root, self.search_dir,
+                    self.search_prefix_length, templates, writer,
+                    changed_terms=state.changed_terms if incremental
+                    else None,
+                    changed_pages=state.changed_pages if incremental
+                    else None, log=self.log)
+            site['search'] = search_inputs
+            site['search_outputs'] = search_outputs
+            site['outputs'] = front_outputs + search_outputs
+        if self.low_memory:
+            index.keep_only(state.sources)
+            index.close()
+
+    def cleanup(self, state, jobs=1, save=True):
+        """Precompress the outputs, remove those the last build wrote and
+        this one didn't, and save the manifest unless save is False."""
+        from pyquo.cache import open_cache
+        writer = state.writer
+        old_manifest = state.old_manifest
+        new_manifest = state.new_manifest
+        with state.profiler.phase('write', calls=0):
+            new_outputs = list(new_manifest['site'].get('outputs', []))
+            old_outputs = []
+            # The last build's outputs are only this build's to remove if
+            # they were written to the same place; manifests from before the
+            # output was recorded were all built in the current directory:
+            if old_manifest.get('output', '.') == new_manifest['output']:
+                old_outputs = list(old_manifest['site'].get('outputs', []) +
+                                   old_manifest['site'].get('compressed', []))
+                for entry in chain(old_manifest['sources'].values(),
+                                   old_manifest['media'].values()):
+                    old_outputs.extend(entry.get('outputs', []))
+            for entry in chain(new_manifest['sources'].values(),
+                               new_manifest['media'].values()):
+                new_outputs.extend(entry.get('outputs', []))
+            precompress = self.precompress
+            if precompress is None:
+                precompress = 'compressed' in old_manifest['site']
+            if precompress and not self.backend.readable:
+                self.log('Outputs written to an archive are not '
+                         'precompressed.')
+            elif precompress:
+                compressible = [path for path in new_outputs
+                                if path.endswith(output.COMPRESSIBLE)]
+                if self.css and self.backend.exists(self.css):
+                    compressible.append(self.css)
+                siblings, compressed = output.precompress(
+                    compressible, jobs, self.backend)
+                new_manifest['site']['compressed'] = siblings
+                new_outputs.extend(siblings)
+                if compressed:
+                    self.log('{} files compressed.'.format(compressed))
+            for removed in manifest.remove_stale_outputs(
+                    old_outputs, new_outputs, self.backend):
+                self.log(removed + ' removed.')
+            if save and self.manifest_file is not None:
+                manifest.save_manifest(new_manifest, self.manifest_file)
+            if self.cache_file:
+                parse_cache = open_cache(self.cache_file)
+                parse_cache.count(hits=writer.stats['cache_hits'],
+                                  misses=writer.stats['cache_misses'])
+                parse_cache.evict(self.cache_size * 1024 * 1024)
+        state.profiler.add_writes(writer.stats)
+        state.profiler.finish()
+        self.log(writer.report())
+
+    def close(self):
+        """Finish writing the outputs, which an ArchiveOutput needs."""
+        self.backend.close()
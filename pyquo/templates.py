@@ -0,0 +1,380 @@
+#!/usr/bin/python3
+
+import os
+import functools
+from string import Template
+
+# The default templates, keyed by file name. A site can override any of
+# them by putting a file of the same name in its template_directory. They
+# are string.Template templates, so a literal dollar sign is written $$.
+
+PAGE = """<html>
+    <title>$title_cased ($category_cased)</title>
+    <body>
+    <header>
+    <h3>$site_title_cased - $category_cased</h3>
+        <nav>
+        <link rel="stylesheet" type="text/css" media="screen" href="$css" />
+        <title>$title</title>
+<a href="$root$homepage">Home</a> | <a href="index.html">$category_cased</a> | <a href="$root$searchpage">Search</a>
+        </nav>
+    </header>
+    <article>
+$header_image        <h2>$title</h2>
+$content
+    </article></body>
+<p></p>
+        <h5>$authors, $date</h5>
+$tags</html>
+"""
+
+HEADER_IMAGE = """    <figure>
+<img src="$src"$srcset loading="lazy" />
+    </figure>
+"""
+
+TAGS = """    <tiny>Tags: $tags</tiny>
+<p></p>
+"""
+
+TAG = """<a href="$root$searchpage#$tag">$tag</a>"""
+
+LIST = """<html>
+    <header>
+    <h3>$site_title</h3>
+        <nav>
+<a href="$root$homepage">Home</a> | <a href="$root$searchpage">Search</a>
+        </nav>
+        <link rel="stylesheet" type="text/css" media="screen" href="$css" />
+        <title>$site_title</title>
+    </header>
+    <body>
+$sections$pagination    </body>
+</html>
+"""
+
+LIST_SECTION = """<h2>$category</h2>
+    <ul>
+$entries    </ul>
+"""
+
+LIST_ENTRY = """<li><a href="$link">$title</a></li>
+"""
+
+MORE_LINK = """<li><a href="$category/index.html">more...</a></li>
+"""
+
+PAGINATION = """    <nav>$links</nav>
+"""
+
+NEWER_LINK = """<a href="$link">newer</a>"""
+
+OLDER_LINK = """<a href="$link">older</a>"""
+
+SEARCH = """<html>
+    <header>
+    <h3>$site_title</h3>
+        <nav>
+        <link rel="stylesheet" type="text/css" media="screen" href="$css" />
+        <title>Search</title>
+<a href="$root$homepage">Home</a> | <a href="$root$searchpage">Search</a>
+        </nav>
+    </header>
+    <body>
+    <input id="search-box" type="search" autofocus placeholder="Search" />
+    <p id="search-status"></p>
+    <ul id="search-results"></ul>
+    <script>var PYQUO_SEARCH = $config;</script>
+    <script>$script</script>
+    </body>
+</html>
+"""
+
+SEARCH_SCRIPT = """
+(function () {
+    var config = PYQUO_SEARCH;
+    var box = document.getElementById('search-box');
+    var status = document.getElementById('search-status');
+    var results = document.getElementById('search-results');
+    var loaded = {};
+    var latest = 0;
+
+    function load(name) {
+        if (!(name in loaded)) {
+            loaded[name] = fetch(config.directory + name + '.json')
+                .then(function (response) {
+                    return response.ok ? response.json() : {};
+                })
+                .catch(function () { return {}; });
+        }
+        return loaded[name];
+    }
+
+    // Each term maps to a flat list of page number, term frequency pairs.
+    function lookup(term) {
+        var shard = term.slice(0, config.prefixLength)
+                        .replace(/[^a-z0-9]/g, '_');
+        return load(shard).then(function (terms) {
+            var frequencies = {};
+            var postings = terms.hasOwnProperty(term) ? terms[term] : [];
+            for (var i = 0; i < postings.length; i += 2) {
+                frequencies[postings[i]] = postings[i + 1];
+            }
+            return frequencies;
+        });
+    }
+
+    function table(id) {
+        return load('pages-' + Math.floor(id / config.pagesPerFile));
+    }
+
+    // As the index's unindexed(): words too short, starting with a digit,
+    // with an underscore, stop words and words pruned as too common.
+    function unindexed(word) {
+        return word.length < 3 || /^[0-9]/.test(word) ||
+            word.indexOf('_') !== -1 || config.ignored.indexOf(word) !== -1;
+    }
+
+    // Pages with every term, best match first, scored with BM25 as the
+    // index's search() scores them. The tables give each page's length.
+    function rank(all) {
+        if (!all.length) {
+            return Promise.resolve([]);
+        }
+        var ids = Object.keys(all[0]).filter(function (id) {
+            return all.every(function (frequencies) {
+                return frequencies.hasOwnProperty(id);
+            });
+        }).map(Number);
+        var idfs = all.map(function (frequencies) {
+            var count = Object.keys(frequencies).length;
+            return Math.log(1 + (config.pages - count + 0.5) / (count + 0.5));
+        });
+        var averageLength = config.totalLength / config.pages || 1;
+        return Promise.all(ids.map(table)).then(function (tables) {
+            var scores = {};
+            ids.forEach(function (id, n) {
+                var length = tables[n][id % config.pagesPerFile][2];
+                var norm = config.k1 * (1 - config.b +
+                                        config.b * length / averageLength);
+                scores[id] = 0;
+                all.forEach(function (frequencies, term) {
+                    var frequency = frequencies[id];
+                    scores[id] += idfs[term] * frequency * (config.k1 + 1) /
+                        (frequency + norm);
+                });
+            });
+            return ids.sort(function (a, b) {
+                return scores[b] - scores[a] || a - b;
+            });
+        });
+    }
+
+    function find(query) {
+        // Tags may contain spaces, so try the whole query as one term first.
+        return lookup(query).then(function (frequencies) {
+            var words = query.split(/[\\s,]+/).filter(Boolean);
+            if (Object.keys(frequencies).length || words.length < 2) {
+                return [frequencies];
+            }
+            return Promise.all(words.map(lookup)).then(function (all) {
+                // Words which can't be indexed only count if a tag has them:
+                return all.filter(function (frequencies, i) {
+                    return Object.keys(frequencies).length ||
+                        !unindexed(words[i]);
+                });
+            });
+        }).then(rank);
+    }
+
+    function show(ids, search) {
+        var blocks = [];
+        ids.forEach(function (id) {
+            var block = Math.floor(id / config.pagesPerFile);
+            if (blocks.indexOf(block) === -1) {
+                blocks.push(block);
+            }
+        });
+        return Promise.all(blocks.map(function (block) {
+            return load('pages-' + block);
+        })).then(function (tables) {
+            if (search !== latest) {
+                return;
+            }
+            results.innerHTML = '';
+            ids.forEach(function (id) {
+                var table = tables[blocks.indexOf(
+                    Math.floor(id / config.pagesPerFile))];
+                var page = table[id % config.pagesPerFile];
+                var item = document.createElement('li');
+                var link = document.createElement('a');
+                link.href = page[0];
+                link.textContent = page[1];
+                item.appendChild(link);
+                results.appendChild(item);
+            });
+            status.textContent = ids.length + ' result' +
+                (ids.length === 1 ? '' : 's');
+        });
+    }
+
+    function search() {
+        var query = box.value.trim().toLowerCase();
+        var current = ++latest;
+        if (!query) {
+            results.innerHTML = '';
+            status.textContent = '';
+            return;
+        }
+        find(query).then(function (ids) { return show(ids, current); });
+    }
+
+    function searchHash() {
+        if (window.location.hash.length > 1) {
+            box.value = decodeURIComponent(window.location.hash.slice(1));
+            search();
+        }
+    }
+
+    var timer = null;
+    box.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(search, 150);
+    });
+    window.addEventListener('hashchange', searchHash);
+    searchHash();
+})();
+"""
+
+ATOM = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+    <title>$title</title>
+    <id>$link</id>
+    <link href="$link" />
+    <link rel="self" href="$feed" />
+    <updated>$updated</updated>
+    <author><name>$author</name></author>
+$entries</feed>
+"""
+
+ATOM_ENTRY = """    <entry>
+        <title>$title</title>
+        <id>$link</id>
+        <link href="$link" />
+        <updated>$updated</updated>
+    </entry>
+"""
+
+RSS = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+<channel>
+    <title>$title</title>
+    <link>$link</link>
+    <description>$title</description>
+$items</channel>
+</rss>
+"""
+
+RSS_ITEM = """    <item>
+        <title>$title</title>
+        <link>$link</link>
+        <guid>$link</guid>
+$published    </item>
+"""
+
+RSS_PUBDATE = """        <pubDate>$date</pubDate>
+"""
+
+SITEMAP = """<?xml version="1.0" encoding="utf-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+$urls</urlset>
+"""
+
+SITEMAP_URL = """<url><loc>$loc</loc>$lastmod</url>
+"""
+
+SITEMAP_LASTMOD = """<lastmod>$date</lastmod>"""
+
+SITEMAP_INDEX = """<?xml version="1.0" encoding="utf-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+$sitemaps</sitemapindex>
+"""
+
+SITEMAP_INDEX_ENTRY = """<sitemap><loc>$loc</loc></sitemap>
+"""
+
+
+DEFAULTS = {
+    'page.html': PAGE,
+    'header_image.html': HEADER_IMAGE,
+    'tags.html': TAGS,
+    'tag.html': TAG,
+    'list.html': LIST,
+    'list_section.html': LIST_SECTION,
+    'list_entry.html': LIST_ENTRY,
+    'more_link.html': MORE_LINK,
+    'pagination.html': PAGINATION,
+    'newer_link.html': NEWER_LINK,
+    'older_link.html': OLDER_LINK,
+    'search.html': SEARCH,
+    'search.js': SEARCH_SCRIPT,
+    'atom.xml': ATOM,
+    'atom_entry.xml': ATOM_ENTRY,
+    'rss.xml': RSS,
+    'rss_item.xml': RSS_ITEM,
+    'rss_pubdate.xml': RSS_PUBDATE,
+    'sitemap.xml': SITEMAP,
+    'sitemap_url.xml': SITEMAP_URL,
+    'sitemap_lastmod.xml': SITEMAP_LASTMOD,
+    'sitemap_index.xml': SITEMAP_INDEX,
+    'sitemap_index_entry.xml': SITEMAP_INDEX_ENTRY,
+}
+
+
+class PageTemplate(Template):
+    """A string.Template compiled once into a str.format string, so that
+    rendering a page is a single C-level format call rather than a regular
+    expression substitution."""
+
+    def __init__(self, template):
+        super().__init__(template)
+        pieces = []
+        position = 0
+        for match in self.pattern.finditer(template):
+            pieces.append(self.escape_braces(template[position:match.start()]))
+            if match.group('escaped') is not None:
+                pieces.append(self.delimiter)
+            elif match.group('invalid') is not None:
+                self._invalid(match)
+            else:
+                pieces.append('{' + (match.group('named') or
+                                     match.group('braced')) + '}')
+            position = match.end()
+        pieces.append(self.escape_braces(template[position:]))
+        self.compiled = ''.join(pieces)
+
+    @staticmethod
+    def escape_braces(text):
+        return text.replace('{', '{{').replace('}', '}}')
+
+    def substitute(self, **fields):
+        return self.compiled.format_map(fields)
+
+
+def load_templates(template_directory=None):
+    """Compile every template once per build, preferring the site's own."""
+    templates = {}
+    for name, text in DEFAULTS.items():
+        if template_directory is not None:
+            path = os.path.join(template_directory, name)
+            if os.path.exists(path):
+                with open(path) as f:
+                    text = f.read()
+        templates[name] = PageTemplate(text)
+    return templates
+
+
+@functools.lru_cache(maxsize=None)
+def default_templates():
+    """The built-in templates, compiled once per process."""
+    return load_templates()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# The phases of a build, in the order they are reported:
+PHASES = ['discover', 'media', 'parse', 'index', 'render', 'write']
+
+
+def clock():
+    return time.perf_counter(), time.process_time()
+
+
+def total_clock():
+    """Like clock(), but counting the CPU time of finished worker
+    processes too."""
+    times = os.times()
+    return time.perf_counter(), (times.user + times.system +
+                                 times.children_user + times.children_system)
+
+
+def since(start):
+    """(wall, cpu) seconds elapsed since a clock() reading."""
+    wall, cpu = clock()
+    return wall - start[0], cpu - start[1]
+
+
+class Profiler(object):
+    """Wall and CPU time, call counts and bytes written for each phase of a
+    build, plus the time spent on each source file.
+
+    Pages built in worker processes are timed there and added up here, so
+    with several jobs the parse and render times are totals across workers
+    and can exceed the wall time of the whole build. The total CPU time
+    includes the workers'.
+    """
+
+    def __init__(self):
+        self.phases = {phase: Counter() for phase in PHASES}
+        self.sources = {}
+        self.start = total_clock()
+        self.elapsed = None
+        self.excluded = [0.0, 0.0]
+
+    def add(self, phase, wall=0.0, cpu=0.0, calls=1, bytes_written=0):
+        self.phases.setdefault(phase, Counter()).update(
+            {'wall': wall, 'cpu': cpu, 'calls': calls,
+             'bytes': bytes_written})
+
+    @contextmanager
+    def phase(self, phase, writer=None, calls=1):
+        """Time the enclosed block. Time the writer spent writing files is
+        taken off, as it is counted as the write phase."""
+        written = (writer.stats['write_wall'], writer.stats['write_cpu'])\
+            if writer is not None else (0.0, 0.0)
+        self.excluded = [0.0, 0.0]
+        start = clock()
+        yield
+        wall, cpu = since(start)
+        wall -= self.excluded[0]
+        cpu -= self.excluded[1]
+        if writer is not None:
+            wall -= writer.stats['write_wall'] - written[0]
+            cpu -= writer.stats['write_cpu'] - written[1]
+        self.add(phase, wall, cpu, calls)
+
+    def exclude(self, start):
+        """Leave the time since a clock() reading out of the phase being
+        timed, e.g. time spent waiting for worker processes."""
+        wall, cpu = since(start)
+        self.excluded[0] += wall
+        self.excluded[1] += cpu
+
+    def add_page(self, path, stats):
+        """Add the timings build_page recorded for a source."""
+        self.add('parse', stats['parse_wall'], stats['parse_cpu'])
+        if stats['render_wall']:
+            self.add('render', stats['render_wall'], stats['render_cpu'])
+        self.sources[path] = (
+            stats['parse_wall'] + stats['render_wall'] + stats['write_wall'],
+            stats['parse_cpu'] + stats['render_cpu'] + stats['write_cpu'])
+
+    def add_writes(self, stats):
+        """Add the write phase from a Writer's stats."""
+        self.add('write', stats['write_wall'], stats['write_cpu'],
+                 calls=stats['written'] + stats['skipped'],
+                 bytes_written=stats['written_bytes'])
+
+    def finish(self):
+        wall, cpu = total_clock()
+        self.elapsed = wall - self.start[0], cpu - self.start[1]
+
+    def slowest(self, count=10):
+        """The count source files which took longest to parse and render."""
+        return sorted(self.sources.items(),
+                      key=lambda item: (-item[1][0], item[0]))[:count]
+
+    def report(self, slowest=10):
+        """Everything recorded, as a JSON-serialisable dict."""
+        if self.elapsed is None:
+            self.finish()
+        wall, cpu = self.elapsed
+        return {
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'phases': {
+                phase: {'wall': round(counts['wall'], 6),
+                        'cpu': round(counts['cpu'], 6),
+                        'calls': counts['calls'],
+                        'bytes': counts['bytes']}
+                for phase, counts in self.phases.items()},
+            'slowest': [{'path': path, 'wall': round(wall, 6),
+                         'cpu': round(cpu, 6)}
+                        for path, (wall, cpu) in self.slowest(slowest)]}
+
+    def table(self, slowest=10):
+        """The report as a table for humans."""
+        report = self.report(slowest)
+        lines = ['{:<10} {:>10} {:>10} {:>8} {:>14}'.format(
+            'phase', 'wall (s)', 'cpu (s)', 'calls', 'bytes written')]
+        for phase, counts in report['phases'].items():
+            lines.append('{:<10} {:>10.3f} {:>10.3f} {:>8} {:>14}'.format(
+                phase, counts['wall'], counts['cpu'], counts['calls'],
+                counts['bytes']))
+        lines.append('{:<10} {:>10.3f} {:>10.3f}'.format(
+            'total', report['wall'], report['cpu']))
+        if report['slowest']:
+            lines.append('')
+            lines.append('Slowest sources:')
+            for source in report['slowest']:
+                lines.append('{:>10.3f}  {}'.format(source['wall'],
+                                                    source['path']))
+        return '\n'.join(lines)
+
+    def save(self, path, slowest=10, **extra):
+        """Write the report as JSON, with any extra top level fields."""
+        report = self.report(slowest)
+        report.update(extra)
+        with open(path, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True))
@@ -4,6 +4,7 @@ import os
 import re
 import json
 import unicodedata
+from html.parser import HTMLParser
 from pyquo import defaults
 
 DEFAULT_PROPERTIES_FILE = os.path.join(os.environ['HOME'], defaults.PROPERTIES)
@@ -37,6 +38,55 @@ def mkdir(directory):
             if not os.path.isdir(directory):
                 raise
 
+def write_file(path, data):
+    """Write text or bytes to path in a single call. It goes to a temporary
+    file first and is renamed into place, so a page being served is never
+    seen half written."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TextExtractor(HTMLParser):
+    """Collect the text nodes of an HTML fragment in a single streaming pass.
+
+    Equivalent to ''.join(BeautifulSoup(html).findAll(text=True)) but without
+    building a tree, which made text extraction the most expensive step of
+    converting a page.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+
+    def handle_data(self, data):
+        self.pieces.append(data)
+
+    # BeautifulSoup keeps these as text nodes too:
+    handle_comment = handle_pi = handle_data
+
+    def handle_decl(self, data):
+        if data.upper().startswith('DOCTYPE'):
+            data = data[len('DOCTYPE'):].lstrip()
+        self.pieces.append(data)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            data = data[len('CDATA['):]
+        self.pieces.append(data)
+
+
+def html_to_text(html):
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return ''.join(extractor.pieces)
+
+
 def parse_args(parser):
     args = vars(parser.parse_args())
     try:
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import traceback
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+RELOAD_PATH = '/__pyquo/reload'
+
+# Appended to every HTML page served, never written to the output files:
+RELOAD_SCRIPT = """<script>
+new EventSource('{}').onmessage = function () {{ location.reload(); }};
+</script>
+""".format(RELOAD_PATH).encode('utf-8')
+
+
+class Reloader(object):
+    """Tells every connected browser to reload when a rebuild finishes."""
+
+    def __init__(self):
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+class LiveReloadHandler(SimpleHTTPRequestHandler):
+    """Serve the built site, adding the reload script to HTML pages and a
+    server-sent events stream at RELOAD_PATH."""
+
+    reloader = None
+
+    def do_GET(self):
+        if self.path == RELOAD_PATH:
+            return self.send_events()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        if not path.endswith('.html') or not os.path.isfile(path):
+            return super().do_GET()
+        with open(path, 'rb') as f:
+            page = f.read()
+        position = page.rfind(b'</body>')
+        if position == -1:
+            position = len(page)
+        page = page[:position] + RELOAD_SCRIPT + page[position:]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(page)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        version = self.reloader.version
+        try:
+            while True:
+                latest = self.reloader.wait(version, timeout=15)
+                if latest == version:
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    version = latest
+                    self.wfile.write(b'data: reload\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def ignored(path):
+    """Editor backups and hidden files, which make skips too."""
+    name = os.path.basename(path)
+    return name.startswith('.') or name.endswith('~')
+
+
+class PollingWatcher(object):
+    """Find changes by comparing the mtime and size of every file."""
+
+    def __init__(self, directories, interval=0.5):
+        self.directories = directories
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        time.sleep(timeout if timeout is not None else self.interval)
+        snapshot = self.scan()
+        changed = {path for path in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(path) != self.snapshot.get(path)}
+        self.snapshot = snapshot
+        return changed
+
+
+class InotifyWatcher(object):
+    """Find changes with Linux inotify, watching every directory below the
+    given ones, including those created later."""
+
+    MASK = (0x00000002 |  # IN_MODIFY
+            0x00000004 |  # IN_ATTRIB
+            0x00000008 |  # IN_CLOSE_WRITE
+            0x00000040 |  # IN_MOVED_FROM
+            0x00000080 |  # IN_MOVED_TO
+            0x00000100 |  # IN_CREATE
+            0x00000200)   # IN_DELETE
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        for directory in directories:
+            self.watch_tree(directory)
+
+    def watch_tree(self, directory):
+        for root, dirs, files in os.walk(directory):
+            wd = self.add_watch(self.fd, os.fsencode(root), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'out of inotify watches')
+                continue
+            self.watches[wd] = root
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                if os.path.isdir(path):
+                    self.watch_tree(path)
+                    for root, dirs, files in os.walk(path):
+                        changed.update(os.path.join(root, name)
+                                       for name in files)
+                continue
+            changed.add(path)
+        return changed
+
+
+def make_watcher(directories, poll=False):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as error:
+            print('inotify unavailable ({}), polling instead.'.format(error))
+    return PollingWatcher(directories)
+
+
+def wait_for_changes(watcher, debounce, on_idle=None, idle=2):
+    """Block until something changes, then keep collecting changes until
+    nothing has happened for debounce seconds. on_idle, if given, is called
+    once nothing has changed for idle seconds."""
+    changed = set()
+    deadline = time.monotonic() + idle
+    while not changed:
+        if on_idle is not None and time.monotonic() >= deadline:
+            on_idle()
+            on_idle = None
+        changed = watcher.changes(None if on_idle is None else debounce)
+    while True:
+        more = watcher.changes(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+
+def serve(directory, host, port, reloader):
+    handler = type('Handler', (LiveReloadHandler,), {'reloader': reloader})
+    server = ThreadingHTTPServer((host, port),
+                                 partial(handler, directory=directory))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def watch(properties, build, host='localhost', port=8000, poll=False,
+          debounce=0.1, save=None):
+    """Serve the site and rebuild it whenever a source, template or media file
+    changes.
+
+    build is called as build(changed, on_pages_written), with changed None
+    at first and then the paths which changed since the last build, so
+    that a rebuild only looks at those. save, if given, is called once
+    nothing has changed for a while and when watching stops, for the
+    manifest to be written then rather than after every rebuild.
+    """
+    source_directory = properties.get('source_directory', 'markdown')
+    media_directory = properties.get('media_directory', 'media')
+    template_directory = properties.get('template_directory')
+    reloader = Reloader()
+
+    build(None, None)
+    server = serve(properties.get('output_directory') or os.getcwd(), host,
+                   port, reloader)
+    watched = [directory for directory in [source_directory, media_directory,
+                                           template_directory]
+               if directory and os.path.isdir(directory)]
+    watcher = make_watcher(watched, poll)
+    print('Serving on http://{}:{}/ and watching {}. Press Ctrl-C to stop.'
+          .format(host, server.server_address[1], ', '.join(watched)))
+    unsaved = save is not None
+
+    def save_when_idle():
+        nonlocal unsaved
+        save()
+        unsaved = False
+
+    try:
+        while True:
+            changed = [path for path in wait_for_changes(
+                watcher, debounce, save_when_idle if unsaved else None)
+                       if not ignored(path)]
+            if not changed:
+                continue
+            start = time.perf_counter()
+            print('{} changed, rebuilding.'.format(', '.join(sorted(changed))))
+            reloaded = []
+
+            def on_pages_written():
+                reloader.notify()
+                reloaded.append(time.perf_counter() - start)
+
+            # A source saved half written, such as a meta block still
+            # being typed, mustn't stop the server; the last good build
+            # stays up until the next change:
+            try:
+                build(changed, on_pages_written)
+            except Exception:
+                traceback.print_exc()
+                print('Rebuild failed, still watching for changes.')
+                continue
+            unsaved = save is not None
+            if reloaded:
+                print('Pages reloaded after {:.0f} ms, rebuild finished '
+                      'after {:.0f} ms.'.format(
+                          1000 * reloaded[0],
+                          1000 * (time.perf_counter() - start)))
+            else:
+                print('Rebuild finished after {:.0f} ms.'.format(
+                    1000 * (time.perf_counter() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if save is not None:
+            save()
@@ -9,8 +9,14 @@ setup(
     author="Darren Hoyland",
     author_email="<darren@hoyland.me>",
     url="https://github.com/autonomouse/PyQuo",
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
+    extras_require={
+        # Resized header images; without it they are only copied:
+        'images': ['Pillow'],
+        # Brotli siblings as well as gzip ones with make --precompress:
+        'brotli': ['Brotli'],
+    },
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
         "Programming Language :: Python",
@@ -0,0 +1,175 @@
+import io
+import os
+import itertools
+import zipfile
+
+from pyquo import output
+from pyquo.site import Site
+
+PROPERTIES = {'source_directory': 'markdown', 'site_title': 'Test',
+              'entries_to_show': 2, 'entries_per_page': 3,
+              'site_url': 'https://example.com'}
+
+WORDS = ('alpha beta gamma delta epsilon zeta theta kappa lambda sigma '
+         'omega python markdown static').split()
+
+# Sources are compared by mtime and size, which an edit within the same
+# second can leave as they were, so each is written a little later:
+STAMPS = itertools.count(1600000000, 10)
+
+
+def write_source(directory, name, title, category='Blog',
+                 date='2020-01-01', tags='', publish='True', body=None):
+    """Write a markdown source under directory, as pyquo new would."""
+    path = os.path.join(str(directory), 'markdown', name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if body is None:
+        body = ' '.join(WORDS[(len(name) + i) % len(WORDS)]
+                        for i in range(30))
+    with open(path, 'w') as f:
+        f.write('Title:          {}\n'
+                'Authors:        Ann\n'
+                'Date:           {}\n'
+                'Tags:           {}\n'
+                'HeaderImage:    \n'
+                'Category:       {}\n'
+                'Publish:        {}\n\n\n{}\n'.format(
+                    title, date, tags, category, publish, body))
+    stamp = next(STAMPS)
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def make_site(directory, count=12):
+    for number in range(count):
+        write_source(directory, 'post{}.md'.format(number),
+                     'Post {}'.format(number),
+                     category=['Blog', 'Work', 'Blog, Personal'][number % 3],
+                     date='2020-01-{:02d}'.format(number + 1),
+                     tags='t{}, common'.format(number % 4),
+                     publish='False' if number == 7 else 'True')
+
+
+def memory_site(directory, **properties):
+    return Site(dict(PROPERTIES, **properties), str(directory),
+                output.MemoryOutput())
+
+
+def built(directory, jobs=1, **properties):
+    """The files of a fresh build of the site into memory."""
+    site = memory_site(directory, **properties)
+    site.build(jobs)
+    return site.backend.files
+
+
+def test_deleted_source_outputs_are_removed(tmp_path):
+    make_site(tmp_path)
+    site = memory_site(tmp_path)
+    site.build()
+    assert 'work/post-1.html' in site.backend.files
+    os.remove(str(tmp_path / 'markdown' / 'post1.md'))
+    site.build()
+    assert 'work/post-1.html' not in site.backend.files
+    assert b'post-1.html' not in site.backend.files['work/index.html']
+    assert site.backend.files == built(tmp_path)
+
+
+def test_unpublished_source_outputs_are_removed(tmp_path):
+    make_site(tmp_path)
+    site = memory_site(tmp_path)
+    site.build()
+    write_source(tmp_path, 'post2.md', 'Post 2', category='Blog, Personal',
+                 date='2020-01-03', tags='t2, common', publish='False')
+    site.build()
+    assert 'blog/post-2.html' not in site.backend.files
+    assert 'personal/post-2.html' not in site.backend.files
+    assert site.backend.files == built(tmp_path)
+
+
+def test_renamed_source_outputs_are_replaced(tmp_path):
+    make_site(tmp_path)
+    site = memory_site(tmp_path)
+    site.build()
+    write_source(tmp_path, 'post0.md', 'Renamed', date='2020-01-01',
+                 tags='t0, common')
+    site.build()
+    assert 'blog/post-0.html' not in site.backend.files
+    assert 'blog/renamed.html' in site.backend.files
+    assert site.backend.files == built(tmp_path)
+
+
+def test_duplicate_titles_keep_the_page_found_last(tmp_path):
+    make_site(tmp_path)
+    write_source(tmp_path, 'a.md', 'Twin', body='first twin')
+    write_source(tmp_path, 'b.md', 'Twin', body='second twin')
+    site = memory_site(tmp_path)
+    site.build()
+    assert b'second twin' in site.backend.files['blog/twin.html']
+    # The shadowed page takes the file back once the other one is gone:
+    os.remove(str(tmp_path / 'markdown' / 'b.md'))
+    site.build()
+    assert b'first twin' in site.backend.files['blog/twin.html']
+    assert site.backend.files == built(tmp_path)
+
+
+def test_selective_builds_leave_other_categories(tmp_path):
+    make_site(tmp_path)
+    site = memory_site(tmp_path)
+    site.build()
+    write_source(tmp_path, 'post0.md', 'Post 0', body='blog edit')
+    write_source(tmp_path, 'post1.md', 'Post 1', category='Work',
+                 date='2020-01-02', body='work edit')
+    site.build(categories=['work'])
+    assert b'work edit' in site.backend.files['work/post-1.html']
+    assert b'blog edit' not in site.backend.files['blog/post-0.html']
+    site.build(exclude=['work'])
+    assert b'blog edit' in site.backend.files['blog/post-0.html']
+    assert site.backend.files == built(tmp_path)
+
+
+def test_low_memory_index_matches(tmp_path):
+    make_site(tmp_path, count=30)
+    assert built(tmp_path, low_memory=True) == built(tmp_path)
+
+
+def test_jobs_write_the_same_bytes(tmp_path):
+    make_site(tmp_path, count=30)
+    assert built(tmp_path, jobs=2) == built(tmp_path, jobs=1)
+
+
+def test_backends_write_the_same_bytes(tmp_path):
+    make_site(tmp_path)
+    files = built(tmp_path)
+    site = Site(dict(PROPERTIES, output_directory='out'), str(tmp_path))
+    site.build()
+    on_disk = {}
+    for root, _, names in os.walk(str(tmp_path / 'out')):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                on_disk[os.path.relpath(path, str(tmp_path / 'out'))] = \
+                    f.read()
+    assert on_disk == files
+    archive = io.BytesIO()
+    site = Site(PROPERTIES, str(tmp_path), output.ArchiveOutput(archive))
+    site.build()
+    site.close()
+    with zipfile.ZipFile(archive) as members:
+        assert {name: members.read(name)
+                for name in members.namelist()} == files
+
+
+def test_changed_build_matches_a_full_build(tmp_path):
+    make_site(tmp_path, count=30)
+    site = memory_site(tmp_path)
+    site.build()
+    edits = [
+        write_source(tmp_path, 'post3.md', 'Post 3', category='Blog',
+                     date='2020-01-04', tags='t3, common', body='new words'),
+        write_source(tmp_path, 'post4.md', 'Retitled', category='Work',
+                     date='2021-06-01', tags='t9')]
+    site.build(changed=edits)
+    assert site.backend.files == built(tmp_path)
+    os.remove(edits[0])
+    site.build(changed=edits[:1])
+    assert site.backend.files == built(tmp_path)